@@ -5,75 +5,42 @@ __author__ = "Shawn Bruce <kantlivelong@gmail.com>"
 __license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
 __copyright__ = "Copyright (C) 2017 Shawn Bruce - Released under terms of the AGPLv3 License"
 
-import octoprint.plugin
-from octoprint.server import user_permission
-from octoprint.events import Events
 import time
 import subprocess
 import threading
 import os
-from flask import make_response, jsonify
 
 try:
-    from octoprint.util import ResettableTimer
-except:
-    class ResettableTimer(threading.Thread):
-        def __init__(self, interval, function, args=None, kwargs=None, on_reset=None, on_cancelled=None):
-            threading.Thread.__init__(self)
-            self._event = threading.Event()
-            self._mutex = threading.Lock()
-            self.is_reset = True
-
-            if args is None:
-                args = []
-            if kwargs is None:
-                kwargs = dict()
-
-            self.interval = interval
-            self.function = function
-            self.args = args
-            self.kwargs = kwargs
-            self.on_cancelled = on_cancelled
-            self.on_reset = on_reset
-
-
-        def run(self):
-            while self.is_reset:
-                with self._mutex:
-                    self.is_reset = False
-                self._event.wait(self.interval)
-
-            if not self._event.isSet():
-                self.function(*self.args, **self.kwargs)
-            with self._mutex:
-                self._event.set()
-
-        def cancel(self):
-            with self._mutex:
-                self._event.set()
-
-            if callable(self.on_cancelled):
-                self.on_cancelled()
-
-        def reset(self, interval=None):
-            with self._mutex:
-                if interval:
-                    self.interval = interval
-
-                self.is_reset = True
-                self._event.set()
-                self._event.clear()
-
-            if callable(self.on_reset):
-                self.on_reset()
-
-
-class PSUControlPlus(octoprint.plugin.StartupPlugin,
-                 octoprint.plugin.TemplatePlugin,
-                 octoprint.plugin.AssetPlugin,
-                 octoprint.plugin.SettingsPlugin,
-                 octoprint.plugin.SimpleApiPlugin,
-                 octoprint.plugin.EventHandlerPlugin):
+    import octoprint.plugin
+    from octoprint.server import user_permission
+    from octoprint.events import Events
+    from octoprint.filemanager import valid_file_type
+    from flask import make_response, jsonify
+
+    class _PluginBase(octoprint.plugin.StartupPlugin,
+                      octoprint.plugin.TemplatePlugin,
+                      octoprint.plugin.AssetPlugin,
+                      octoprint.plugin.SettingsPlugin,
+                      octoprint.plugin.SimpleApiPlugin,
+                      octoprint.plugin.EventHandlerPlugin):
+        pass
+except ImportError:
+    # Lets the offline tools (idlesim, the coordinator) run without OctoPrint installed.
+    _PluginBase = object
+
+from .coordinator import CoordinatorClient, CoordinatorError
+from .gcodescan import GCodeScanCache, scan_file, file_key
+from .sensing import GPIOSenseReader, SenseFilter
+from .history import HistoryStore, channel_mask, EVENT_IDLE_POWEROFF
+from . import journal
+from .journal import EventJournal
+from .pwm import PWMOutput, RampProfile
+from .statecache import StateCache, etag_matches
+from .idlepolicy import (IdlePolicy, DeadlineScheduler, resets_idle_timer, triggers_auto_on,
+                         tool_temperatures, parsed_tool_temperatures, heaters_cooled)
+
+
+class PSUControlPlus(_PluginBase):
 
     def __init__(self):
         try:
@@ -106,6 +73,12 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
         self.autoOn = False
         self.autoOnTriggerGCodeCommands = ''
         self._autoOnTriggerGCodeCommandsArray = []
+        self.preArmEnabled = False
+        self.preArmEvents = ''
+        self._preArmEventsArray = []
+        self.preArmWindow = 0
+        self._preArmedAt = None
+        self._preArming = False
         self.enablePowerOffWarningDialog = True
         self.powerOffWhenIdle = False
         self.powerOffPSUWhenIdle = False
@@ -115,20 +88,68 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
         self.idleIgnoreCommands = ''
         self._idleIgnoreCommandsArray = []
         self.idleTimeoutWaitTemp = 0
+        self.idlePolicies = dict()
         self.disconnectOnPowerOff = False
         self.sensingMethod = ''
         self.sensePollingInterval = 0
         self.senseGPIOPin = 0
+        self.senseLightGPIOPin = 0
+        self.senseFanGPIOPin = 0
+        self.senseGPIOChip = ''
         self.invertsenseGPIOPin = False
         self.senseGPIOPinPUD = ''
         self.senseSystemCommand = ''
+        self.senseFilterEnabled = False
+        self.senseFilterWindow = 0
+        self.senseFilterHysteresis = 0
+        self.senseFilterDwell = 0.0
+        self._senseFilters = dict()
+        self._broadcastState = None
+        self.powerWatts = {"PSU":0.0, "Light":0.0, "Fan":0.0}
+        self.fanPWM = False
+        self.fanPWMFrequency = 0
+        self.fanPWMHardware = False
+        self.fanPWMDuty = 0.0
+        self.fanRampMode = ''
+        self.fanRampProfile = ''
+        self._fanRamp = None
+        self._fanRampStart = None
+        self._fanPWMOutput = None
+        self._history = HistoryStore()
+        self.journalEnabled = False
+        self._journal = None
         self._noSensing_isPSUOn = False
         self._check_psu_state_thread = None
         self._check_psu_state_event= threading.Event()
-        self._idleTimer = None
-        self._waitForHeaters = False
+        self._switchMutex = threading.RLock()
+        self._scheduler = None
+        self._idleRecheckInterval = 30
+        self._idleArmedAt = {"PSU":0, "Light":0, "Fan":0}
+        self._idleWaiting = dict()
+        self._lastActivity = 0
         self._skipIdleTimer = False
         self._configuredGPIOPins = []
+        self._senseReader = None
+        self._senseSnapshot = None
+        self.coordinatorEnabled = False
+        self.coordinatorSocket = ''
+        self.coordinatorClientId = ''
+        self.coordinatorLeaseTTL = 0
+        self.staggerPowerOn = False
+        self.coordinatorPowerOnTimeout = 0
+        self._coordinator = None
+        self._coordinatorLeases = set()
+        self._powerOnAdmission = None
+        self._gcodeScanCache = GCodeScanCache()
+        self._jobOrigin = None
+        self._jobPath = None
+        self._jobScan = None
+        self._jobScanMutex = threading.Lock()
+        self._jobScanQueue = []
+        self._jobScanThread = None
+        self._jobFastPath = False
+        self._stateCache = StateCache()
+        self._bulkStateCache = StateCache()
 
 
     def on_settings_initialized(self):
@@ -159,6 +180,10 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
         self.lightEnabled = self._settings.get_boolean(["lightEnabled"])
         self.fanEnabled = self._settings.get_boolean(["fanEnabled"])
 
+        self._load_fan_pwm()
+        params = (self.fanPWM, self.fanPWMFrequency, self.fanPWMHardware, self.fanPWMDuty, self.fanRampMode, self.fanRampProfile)
+        self._logger.debug("fanPWM: %s, frequency: %s, hardware: %s, duty: %s, ramp: %s %s" % params)
+
         self.onGCodeCommand = self._settings.get(["onGCodeCommand"])
         self._logger.debug("onGCodeCommand: %s" % self.onGCodeCommand)
 
@@ -202,6 +227,15 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
         self.senseGPIOPin = self._settings.get_int(["senseGPIOPin"])
         self._logger.debug("senseGPIOPin: %s" % self.senseGPIOPin)
 
+        self.senseLightGPIOPin = self._settings.get_int(["senseLightGPIOPin"])
+        self._logger.debug("senseLightGPIOPin: %s" % self.senseLightGPIOPin)
+
+        self.senseFanGPIOPin = self._settings.get_int(["senseFanGPIOPin"])
+        self._logger.debug("senseFanGPIOPin: %s" % self.senseFanGPIOPin)
+
+        self.senseGPIOChip = self._settings.get(["senseGPIOChip"])
+        self._logger.debug("senseGPIOChip: %s" % self.senseGPIOChip)
+
         self.invertsenseGPIOPin = self._settings.get_boolean(["invertsenseGPIOPin"])
         self._logger.debug("invertsenseGPIOPin: %s" % self.invertsenseGPIOPin)
 
@@ -211,6 +245,28 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
         self.senseSystemCommand = self._settings.get(["senseSystemCommand"])
         self._logger.debug("senseSystemCommand: %s" % self.senseSystemCommand)
 
+        self.senseFilterEnabled = self._settings.get_boolean(["senseFilterEnabled"])
+        self._logger.debug("senseFilterEnabled: %s" % self.senseFilterEnabled)
+
+        self.senseFilterWindow = self._settings.get_int(["senseFilterWindow"])
+        self._logger.debug("senseFilterWindow: %s" % self.senseFilterWindow)
+
+        self.senseFilterHysteresis = self._settings.get_int(["senseFilterHysteresis"])
+        self._logger.debug("senseFilterHysteresis: %s" % self.senseFilterHysteresis)
+
+        self.senseFilterDwell = self._settings.get_float(["senseFilterDwell"])
+        self._logger.debug("senseFilterDwell: %s" % self.senseFilterDwell)
+
+        self._configure_sense_filters()
+
+        self.powerWatts = {
+            "PSU": self._settings.get_float(["powerPSUWatts"]),
+            "Light": self._settings.get_float(["powerLightWatts"]),
+            "Fan": self._settings.get_float(["powerFanWatts"])
+        }
+        params = (self.powerWatts['PSU'], self.powerWatts['Light'], self.powerWatts['Fan'])
+        self._logger.debug("powerWatts: psu: %s, light: %s, fan: %s" % params)
+
         self.autoOn = self._settings.get_boolean(["autoOn"])
         self._logger.debug("autoOn: %s" % self.autoOn)
 
@@ -218,6 +274,16 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
         self._autoOnTriggerGCodeCommandsArray = self.autoOnTriggerGCodeCommands.split(',')
         self._logger.debug("autoOnTriggerGCodeCommands: %s" % self.autoOnTriggerGCodeCommands)
 
+        self.preArmEnabled = self._settings.get_boolean(["preArmEnabled"])
+        self._logger.debug("preArmEnabled: %s" % self.preArmEnabled)
+
+        self.preArmEvents = self._settings.get(["preArmEvents"])
+        self._preArmEventsArray = [e.strip() for e in self.preArmEvents.split(',') if e.strip()]
+        self._logger.debug("preArmEvents: %s" % self.preArmEvents)
+
+        self.preArmWindow = self._settings.get_int(["preArmWindow"])
+        self._logger.debug("preArmWindow: %s" % self.preArmWindow)
+
         self.enablePowerOffWarningDialog = self._settings.get_boolean(["enablePowerOffWarningDialog"])
         self._logger.debug("enablePowerOffWarningDialog: %s" % self.enablePowerOffWarningDialog)
 
@@ -234,6 +300,33 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
         self.idleTimeoutWaitTemp = self._settings.get_int(["idleTimeoutWaitTemp"])
         self._logger.debug("idleTimeoutWaitTemp: %s" % self.idleTimeoutWaitTemp)
 
+        self._load_idle_policies()
+        self._logger.debug("idlePolicies: %s" % self.idlePolicies)
+
+        self.journalEnabled = self._settings.get_boolean(["journalEnabled"])
+        self._logger.debug("journalEnabled: %s" % self.journalEnabled)
+        self._configure_journal()
+
+        self.coordinatorEnabled = self._settings.get_boolean(["coordinatorEnabled"])
+        self._logger.debug("coordinatorEnabled: %s" % self.coordinatorEnabled)
+
+        self.coordinatorSocket = self._settings.get(["coordinatorSocket"])
+        self._logger.debug("coordinatorSocket: %s" % self.coordinatorSocket)
+
+        self.coordinatorClientId = self._settings.get(["coordinatorClientId"])
+        self._logger.debug("coordinatorClientId: %s" % self.coordinatorClientId)
+
+        self.coordinatorLeaseTTL = self._settings.get_int(["coordinatorLeaseTTL"])
+        self._logger.debug("coordinatorLeaseTTL: %s" % self.coordinatorLeaseTTL)
+
+        self.staggerPowerOn = self._settings.get_boolean(["staggerPowerOn"])
+        self._logger.debug("staggerPowerOn: %s" % self.staggerPowerOn)
+
+        self.coordinatorPowerOnTimeout = self._settings.get_int(["coordinatorPowerOnTimeout"])
+        self._logger.debug("coordinatorPowerOnTimeout: %s" % self.coordinatorPowerOnTimeout)
+
+        self._configure_coordinator()
+
         scripts = self._settings.listScripts("gcode")
         if not "psucontrol_post_on" in scripts:
             self._settings.saveScript("gcode", "psucontrol_post_on", u'')
@@ -259,6 +352,9 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
         if self.switchingMethod == 'GPIO' or self.sensingMethod == 'GPIO':
             self._configure_gpio()
 
+        self._scheduler = DeadlineScheduler(self._logger)
+        self._scheduler.start()
+
         self._check_psu_state_thread = threading.Thread(target=self._check_psu_state)
         self._check_psu_state_thread.daemon = True
         self._check_psu_state_thread.start()
@@ -317,7 +413,21 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
         
         GPIO.setwarnings(False)
 
+        # Relays shared through the coordinator keep their level, another instance may be using them.
+        keepOutputs = self._coordinator is not None and self.switchingMethod == 'GPIO'
+
+        # A shared fan restarts at the duty it was running at rather than stopping.
+        fanDuty = self.fanPWMDuty if keepOutputs and self.isFanOn() else 0
+        if self._fanPWMOutput is not None:
+            if keepOutputs:
+                fanDuty = self._fanPWMOutput.duty
+            self._fanPWMOutput.close(zero=not keepOutputs)
+            self._fanPWMOutput = None
+        sharedPins = list(self.onoffGPIOPin.values()) if keepOutputs else []
+
         for pin in self._configuredGPIOPins:
+            if pin in sharedPins:
+                continue
             self._logger.debug("Cleaning up pin %s" % pin)
             try:
                 GPIO.cleanup(self._gpio_get_pin(pin))
@@ -333,9 +443,12 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
             else:
                 return
         
+        if self._senseReader is not None:
+            self._senseReader.close()
+            self._senseReader = None
+
         if self.sensingMethod == 'GPIO':
             self._logger.info("Using GPIO sensing to determine PSU on/off state.")
-            self._logger.info("Configuring GPIO sensing on pin %s" % self.senseGPIOPin)
 
             if self.senseGPIOPinPUD == 'PULL_UP':
                 pudsenseGPIOPin = GPIO.PUD_UP
@@ -343,12 +456,22 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
                 pudsenseGPIOPin = GPIO.PUD_DOWN
             else:
                 pudsenseGPIOPin = GPIO.PUD_OFF
-    
-            try:
-                GPIO.setup(self._gpio_get_pin(self.senseGPIOPin), GPIO.IN, pull_up_down=pudsenseGPIOPin)
-                self._configuredGPIOPins.append(self.senseGPIOPin)
-            except (RuntimeError, ValueError) as e:
-                self._logger.error(e)
+
+            sensePins = dict()
+            senseOffsets = dict()
+            for fn, pin in self._sense_gpio_pins().items():
+                self._logger.info("Configuring %s GPIO sensing on pin %s" % (fn, pin))
+                try:
+                    GPIO.setup(self._gpio_get_pin(pin), GPIO.IN, pull_up_down=pudsenseGPIOPin)
+                    self._configuredGPIOPins.append(pin)
+                    sensePins[fn] = self._gpio_get_pin(pin)
+                    senseOffsets[fn] = pin if self.GPIOMode == 'BCM' else self._gpio_board_to_bcm(pin)
+                except (RuntimeError, ValueError) as e:
+                    self._logger.error(e)
+
+            self._senseReader = GPIOSenseReader(GPIO, sensePins, senseOffsets, self.senseGPIOChip, self._logger)
+            if self._senseReader.batched:
+                self._logger.info("Reading sense pins together through libgpiod on %s" % self.senseGPIOChip)
         
         if self.switchingMethod == 'GPIO':
             self._logger.info("Using GPIO for On/Off")
@@ -359,15 +482,241 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
                         initial_pin_output=GPIO.LOW
                     else:
                         initial_pin_output=GPIO.HIGH
-                    GPIO.setup(self._gpio_get_pin(self.onoffGPIOPin[fn]), GPIO.OUT, initial=initial_pin_output)
+                    if keepOutputs:
+                        GPIO.setup(self._gpio_get_pin(self.onoffGPIOPin[fn]), GPIO.OUT)
+                    else:
+                        GPIO.setup(self._gpio_get_pin(self.onoffGPIOPin[fn]), GPIO.OUT, initial=initial_pin_output)
                     self._configuredGPIOPins.append(self.onoffGPIOPin[fn])
                 except (RuntimeError, ValueError) as e:
                     self._logger.error(e)
 
+            if self.fanEnabled and self.fanPWM:
+                pin = self.onoffGPIOPin['Fan']
+                self._logger.info("Configuring Fan PWM on pin %s at %s Hz" % (pin, self.fanPWMFrequency))
+                try:
+                    self._fanPWMOutput = PWMOutput(GPIO, self._gpio_get_pin(pin),
+                                                   pin if self.GPIOMode == 'BCM' else self._gpio_board_to_bcm(pin),
+                                                   self.fanPWMFrequency, self.invertonoffGPIOPin['Fan'],
+                                                   self.fanPWMHardware, self._logger, fanDuty)
+                    self._logger.info("Using %s PWM for the fan" % self._fanPWMOutput.backend)
+                except (RuntimeError, ValueError) as e:
+                    self._logger.error(e)
+
+    def _load_fan_pwm(self):
+        self.fanPWM = self._settings.get_boolean(["fanPWM"])
+        self.fanPWMFrequency = self._settings.get_int(["fanPWMFrequency"])
+        self.fanPWMHardware = self._settings.get_boolean(["fanPWMHardware"])
+        self.fanPWMDuty = self._settings.get_float(["fanPWMDuty"])
+        self.fanRampMode = self._settings.get(["fanRampMode"])
+        self.fanRampProfile = self._settings.get(["fanRampProfile"])
+
+        self._fanRamp = None
+        if self.fanRampMode in ('TIME', 'TEMPERATURE'):
+            try:
+                self._fanRamp = RampProfile.parse(self.fanRampProfile)
+            except ValueError as e:
+                self._logger.warning("Ignoring fan ramp profile %r: %s" % (self.fanRampProfile, e))
+
+    def _start_fan_ramp(self):
+        # Time ramps run from when the fan is switched on or a print ends, and wait out running prints.
+        if self._fanRamp is None or self._fanPWMOutput is None or self._scheduler is None:
+            return
+        if self.fanRampMode == 'TIME' and (self._printer.is_printing() or self._printer.is_paused()):
+            return
+        self._fanRampStart = time.time()
+        self._scheduler.schedule("FanRamp", self._fanRampStart, self._fan_ramp_step)
+
+    def _stop_fan_ramp(self):
+        self._fanRampStart = None
+        if self._scheduler is not None:
+            self._scheduler.cancel("FanRamp")
+
+    def _fan_ramp_step(self, temps=None):
+        with self._switchMutex:
+            if self._fanRampStart is None or self._fanPWMOutput is None or not self.isFanOn():
+                return
+
+            if self.fanRampMode == 'TIME':
+                elapsed = time.time() - self._fanRampStart
+                self._fanPWMOutput.set_duty(self._fanRamp.duty_at(elapsed))
+                next_change = self._fanRamp.next_change(elapsed)
+                if next_change is not None:
+                    self._scheduler.schedule("FanRamp", self._fanRampStart + next_change, self._fan_ramp_step)
+            else:
+                if temps is None:
+                    temps = tool_temperatures(self._printer.get_current_temperatures())
+                duty = self._fanRamp.duty_at(max(list(temps.values()) + [0]))
+                if abs(duty - self._fanPWMOutput.duty) >= 1:
+                    self._fanPWMOutput.set_duty(duty)
+
+    def _set_fan_duty(self, duty):
+        # A duty set through the API overrides the ramp until the fan is switched again or a print ends.
+        with self._switchMutex:
+            if duty <= 0:
+                self.turn("Fan", "Off")
+                return
+            if not self.isFanOn():
+                self.turn("Fan", "On")
+            self._stop_fan_ramp()
+            self._fanPWMOutput.set_duty(duty)
+            self._journal_event(journal.DUTY, "Fan", self._fanPWMOutput.duty)
+
+    def _configure_coordinator(self):
+        if not self.coordinatorEnabled:
+            self._coordinator = None
+            return
+
+        client_id = self.coordinatorClientId or self.get_plugin_data_folder()
+        self._coordinator = CoordinatorClient(self.coordinatorSocket, client_id)
+        self._logger.info("Using shared power coordinator at %s as %s" % (self.coordinatorSocket, client_id))
+
+    def _coordinator_request(self, op, **kwargs):
+        if self._coordinator is None:
+            return None
+
+        try:
+            return self._coordinator.request(op, **kwargs)
+        except CoordinatorError as e:
+            self._logger.warning("Power coordinator unavailable: %s" % e)
+            return None
+
+    def _coordinator_acquire(self, what):
+        # True when this instance should physically switch the channel on.
+        self._coordinatorLeases.add(what)
+        r = self._coordinator_request("acquire", channel=what, ttl=self.coordinatorLeaseTTL)
+        if r is None or r["first"]:
+            return True
+
+        self._logger.info("%s already powered for %d other instance(s)" % (what, r["holders"] - 1))
+        return False
+
+    def _coordinator_release(self, what):
+        # True when this instance should physically switch the channel off.
+        self._coordinatorLeases.discard(what)
+        if self._coordinator is None:
+            return True
+        r = self._coordinator_request("release", channel=what)
+        if r is None:
+            # Other instances may still need it, leave it on rather than guess.
+            self._logger.warning("Not switching shared %s off without the power coordinator" % what)
+            return False
+        if r["last"]:
+            return True
+
+        self._logger.info("%s still leased by %d other instance(s), not switching off" % (what, r["holders"]))
+        return False
+
+    def _coordinator_power_on(self):
+        # Takes the PSU lease and, when staggered, a power-on slot. Instances that
+        # aren't first wait until the first one has powered the PSU. Called before
+        # taking the switch lock, so sensing, the scheduler and other switches go
+        # on meanwhile. True when this instance should switch the PSU on.
+        if self._coordinator is None:
+            return True
+
+        deadline = time.time() + self.coordinatorPowerOnTimeout
+        while True:
+            self._coordinatorLeases.add("PSU")
+            r = self._coordinator_request("acquire", channel="PSU", ttl=self.coordinatorLeaseTTL)
+            if r is None:
+                return True
+
+            if r["first"]:
+                if not self.staggerPowerOn:
+                    return True
+                a = self._coordinator_request("admit")
+                self._powerOnAdmission = a
+                if a is None or a["granted"]:
+                    return True
+                self._logger.info("Waiting for power-on slot (position %s, ETA %ss)" % (a["position"], a["eta"]))
+                pause = min(max(a["eta"], 0.2), 1.0)
+            elif r["powered"]:
+                self._logger.info("PSU already powered for %d other instance(s)" % (r["holders"] - 1))
+                return False
+            else:
+                self._logger.info("Waiting for another instance to finish powering the PSU on")
+                pause = 0.5
+
+            if time.time() + pause > deadline:
+                self._logger.warning("Waited %ss to power the PSU on, switching it now" % self.coordinatorPowerOnTimeout)
+                return True
+            time.sleep(pause)
+
+    def _power_on_slot_done(self):
+        if self._powerOnAdmission is None:
+            return
+        self._powerOnAdmission = None
+        self._coordinator_request("done")
+
+    def _abandon_power_on(self):
+        # The state changed while _coordinator_power_on() waited and the PSU isn't switched after all.
+        self._power_on_slot_done()
+        if self._coordinator is not None and not self.isPSUOn():
+            self._coordinator_release("PSU")
+
+    def _coordinator_renew(self):
+        if self._coordinator is None or not self._coordinatorLeases or not self.coordinatorLeaseTTL:
+            return
+        # Renewing takes back lost leases, so it must not race a release.
+        with self._switchMutex:
+            channels = list(self._coordinatorLeases)
+            powered = [what for what in channels if self._isWhatOn(what, '')]
+            r = self._coordinator_request("renew", channels=channels, ttl=self.coordinatorLeaseTTL, powered=powered)
+        if r is not None and r.get("reacquired"):
+            self._logger.warning("Power coordinator had lost leases on %s, reacquired" % ", ".join(r["reacquired"]))
+
+    def _sense_gpio_pins(self):
+        pins = dict(PSU=self.senseGPIOPin)
+        if self.lightEnabled and self.senseLightGPIOPin:
+            pins["Light"] = self.senseLightGPIOPin
+        if self.fanEnabled and self.senseFanGPIOPin:
+            pins["Fan"] = self.senseFanGPIOPin
+        return pins
+
+    def _configure_sense_filters(self):
+        if not self.senseFilterEnabled:
+            self._senseFilters = dict()
+            return
+
+        self._senseFilters = dict((fn, SenseFilter(self.senseFilterWindow, self.senseFilterHysteresis, self.senseFilterDwell))
+                                  for fn in ['PSU', 'Light', 'Fan'])
+
+    def _filter_sense(self, what, value):
+        senseFilter = self._senseFilters.get(what)
+        if senseFilter is None:
+            return value
+        return senseFilter.update(value)
+
+    def _reset_sense_filter(self, what, how):
+        senseFilter = self._senseFilters.get(what)
+        if senseFilter is not None:
+            senseFilter.reset(how == 'On')
+
     def check_psu_state(self):
         self._check_psu_state_event.set()
 
+    def _configure_journal(self):
+        if self.journalEnabled and self._journal is None:
+            self._journal = EventJournal(os.path.join(self.get_plugin_data_folder(), "journal.jsonl"),
+                                         logger=self._logger)
+        elif not self.journalEnabled and self._journal is not None:
+            self._journal.stop()
+            self._journal = None
+
+    def _journal_event(self, kind, channel=None, value=None):
+        if self._journal is not None:
+            self._journal.emit(kind, channel, value)
+
+    def _record_history(self):
+        states = dict(PSU=self.isPSUOn(), Light=self.isLightOn(), Fan=self.isFanOn())
+        watts = None
+        if any(self.powerWatts.values()):
+            watts = sum(self.powerWatts[fn] for fn, on in states.items() if on)
+        self._history.record(channel_mask(states), watts)
+
     def _check_all_state(self):
+        self._record_history()
+        self._broadcastState = (self.isPSUOn(), self.isFanOn(), self.isLightOn())
         self._plugin_manager.send_plugin_message(self._identifier,
            dict(
                 isPSUOn=self.isPSUOn(),
@@ -376,110 +725,230 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
 
     def _check_psu_state(self):
         while True:
-            old_isPSUOn = self.isPSUOn()
+            if not self._sense_all_state():
+                return
+            self._coordinator_renew()
+
+            self._check_psu_state_event.wait(self.sensePollingInterval)
+            self._check_psu_state_event.clear()
+
+    def _sense_all_state(self):
+        # Held across read and update so a reading taken before a switch can't overwrite its state.
+        with self._switchMutex:
+            old_state = dict((fn, self._isWhatOn(fn, '')) for fn in ['PSU', 'Light', 'Fan'])
 
             if self.sensingMethod == 'GPIO':
                 if not self._hasGPIO:
-                    return
+                    return False
 
                 self._logger.debug("Polling PSU state...")
 
-                r = 0
+                values = dict()
                 try:
-                    r = GPIO.input(self._gpio_get_pin(self.senseGPIOPin))
-                except (RuntimeError, ValueError) as e:
+                    if self._senseReader is not None:
+                        self._senseSnapshot = self._senseReader.read()
+                        values = self._senseSnapshot.values
+                except (RuntimeError, ValueError, OSError) as e:
                     self._logger.error(e)
-                self._logger.debug("Result: %s" % r)
+                self._logger.debug("Result: %s", values)
 
-                if r==1:
-                    new_isPSUOn = True
-                elif r==0:
-                    new_isPSUOn = False
+                for fn in ['PSU', 'Light', 'Fan']:
+                    if fn != 'PSU' and fn not in values:
+                        continue
 
-                if self.invertsenseGPIOPin:
-                    new_isPSUOn = not new_isPSUOn
+                    new_isOn = values.get(fn, 0) == 1
+                    if self.invertsenseGPIOPin:
+                        new_isOn = not new_isOn
+                    new_isOn = self._filter_sense(fn, new_isOn)
 
-                self.isPSUOn('On' if new_isPSUOn else 'Off')
+                    self._isWhatOn(fn, 'On' if new_isOn else 'Off')
             elif self.sensingMethod == 'SYSTEM':
                 new_isPSUOn = False
 
                 p = subprocess.Popen(self.senseSystemCommand, shell=True)
-                self._logger.debug("Sensing system command executed. PID=%s, Command=%s" % (p.pid, self.senseSystemCommand))
+                self._logger.debug("Sensing system command executed. PID=%s, Command=%s", p.pid, self.senseSystemCommand)
                 while p.poll() is None:
                     time.sleep(0.1)
                 r = p.returncode
-                self._logger.debug("Sensing system command returned: %s" % r)
+                self._logger.debug("Sensing system command returned: %s", r)
 
                 if r==0:
                     new_isPSUOn = True
                 elif r==1:
                     new_isPSUOn = False
+                new_isPSUOn = self._filter_sense('PSU', new_isPSUOn)
 
                 self.isPSUOn('On' if new_isPSUOn else 'Off')
             elif self.sensingMethod == 'INTERNAL':
                 self.isPSUOn('On' if self._noSensing_isPSUOn else 'Off')
             else:
-                return
+                return False
             
-            self._logger.debug("isPSUOn: %s" % self.isPSUOn())
+            self._logger.debug("isPSUOn: %s", self.isPSUOn())
 
-            if (old_isPSUOn != self.isPSUOn()) and self.isPSUOn():
-                self._start_idle_timer()
-            elif (old_isPSUOn != self.isPSUOn()) and not self.isPSUOn():
-                self._stop_idle_timer()
-
-            self._check_all_state()
-
-            self._check_psu_state_event.wait(self.sensePollingInterval)
-            self._check_psu_state_event.clear()
+            for fn in ['PSU', 'Light', 'Fan']:
+                if old_state[fn] != self._isWhatOn(fn, ''):
+                    self._journal_event(journal.STATE, fn, self.onoffGPIOState[fn])
+                    self._idle_state_changed(fn)
 
-    def _start_idle_timer(self):
-        self._stop_idle_timer()
-        self.powerOffWhenIdle = (self.powerOffPSUWhenIdle and self.isPSUOn()) or (self.powerOffFanWhenIdle and self.isFanOn()) or (self.powerOffLightWhenIdle and self.isLightOn())
-        if self.powerOffWhenIdle:
-            self._idleTimer = ResettableTimer(self.idleTimeout * 60, self._idle_poweroff)
-            self._idleTimer.start()
+            if self._broadcastState != (self.isPSUOn(), self.isFanOn(), self.isLightOn()):
+                self._check_all_state()
+            else:
+                self._record_history()
+            return True
 
-    def _stop_idle_timer(self):
-        if self._idleTimer:
-            self._idleTimer.cancel()
-            self._idleTimer = None
+    def _load_idle_policies(self):
+        self.powerOffPSUWhenIdle = self._settings.get_boolean(["powerOffPSUWhenIdle"])
+        self.powerOffLightWhenIdle = self._settings.get_boolean(["powerOffLightWhenIdle"])
+        self.powerOffFanWhenIdle = self._settings.get_boolean(["powerOffFanWhenIdle"])
+        enabled = {"PSU": self.powerOffPSUWhenIdle, "Light": self.powerOffLightWhenIdle, "Fan": self.powerOffFanWhenIdle}
+
+        policies = dict()
+        for fn in ['PSU', 'Light', 'Fan']:
+            # Negative timeout or wait temperature falls back to the shared setting.
+            timeout = self._settings.get_float(["idle%sTimeout" % fn])
+            if timeout is None or timeout < 0:
+                timeout = self.idleTimeout
+            waitTemp = self._settings.get_float(["idle%sWaitTemp" % fn])
+            if waitTemp is None or waitTemp < 0:
+                waitTemp = self.idleTimeoutWaitTemp
+            # The PSU always has its own timeout, it must not follow the light or fan.
+            after = ''
+            afterDelay = 0
+            if fn != 'PSU':
+                after = self._settings.get(["idle%sAfter" % fn]) or ''
+                if after == fn or after not in ('PSU', 'Light', 'Fan'):
+                    after = ''
+                afterDelay = self._settings.get_float(["idle%sAfterDelay" % fn]) or 0
+            heatersOff = self._settings.get_boolean(["idle%sHeatersOff" % fn])
+
+            policies[fn] = IdlePolicy(
+                enabled=bool(enabled[fn]),
+                timeout=timeout * 60,
+                waitTemp=waitTemp,
+                heatersOff=heatersOff is not False,
+                after=after,
+                afterDelay=afterDelay * 60)
+        self.idlePolicies = policies
+
+    def _update_power_off_when_idle(self):
+        self.powerOffWhenIdle = any(policy.enabled and self._isWhatOn(fn, '') for fn, policy in self.idlePolicies.items())
+
+    def _start_idle_timer(self, what=None):
+        if self._scheduler is None:
+            return
 
-    def _reset_idle_timer(self):
-        try:
-            if self._idleTimer.is_alive():
-                self._idleTimer.reset()
+        now = time.time()
+        for fn in ([what] if what else ['PSU', 'Light', 'Fan']):
+            self._idleArmedAt[fn] = now
+            self._idleWaiting.pop(fn, None)
+            policy = self.idlePolicies.get(fn)
+            if policy is None or not policy.enabled or not self._isWhatOn(fn, ''):
+                self._scheduler.cancel(fn)
+            elif not policy.after:
+                self._scheduler.schedule(fn, now + policy.timeout, self._idle_poweroff, fn)
+            elif not self._isWhatOn(policy.after, ''):
+                # Its channel is already off, so the delay runs from now.
+                self._scheduler.schedule(fn, now + policy.afterDelay, self._idle_poweroff, fn)
             else:
-                raise Exception()
-        except:
-            self._start_idle_timer()
+                self._scheduler.cancel(fn)
+        self._update_power_off_when_idle()
 
-    def _idle_poweroff(self):
-        self._logger.info("_idle_poweroff. powerOffWhenIdle: %s", self.powerOffWhenIdle);
-        if not self.powerOffWhenIdle:
+    def _stop_idle_timer(self, what=None):
+        if self._scheduler is None:
             return
-        
-        if self._waitForHeaters:
+
+        for fn in ([what] if what else ['PSU', 'Light', 'Fan']):
+            self._idleWaiting.pop(fn, None)
+            self._scheduler.cancel(fn)
+        self._update_power_off_when_idle()
+
+    def _idle_state_changed(self, what):
+        if self._isWhatOn(what, ''):
+            self._start_idle_timer(what)
             return
-        
-        if self._printer.is_printing() or self._printer.is_paused():
+
+        self._stop_idle_timer(what)
+        if self._scheduler is None:
             return
+        now = time.time()
+        for fn, policy in self.idlePolicies.items():
+            if policy.enabled and policy.after == what and self._isWhatOn(fn, ''):
+                self._scheduler.schedule(fn, now + policy.afterDelay, self._idle_poweroff, fn)
+
+    def _idle_deadline(self, what):
+        deadline = self._scheduler.deadline(what) if self._scheduler is not None else None
+        policy = self.idlePolicies.get(what)
+        if deadline is None or policy is None or policy.after or what in self._idleWaiting:
+            return deadline
+        # The scheduled deadline lags behind activity, see _idle_activity.
+        return max(deadline, max(self._lastActivity, self._idleArmedAt[what]) + policy.timeout)
+
+    def _idle_activity(self):
+        # Called for every non-ignored command, so only the timestamp is updated here.
+        # Deadlines are pushed back when they come due.
+        self._lastActivity = time.time()
+
+    def _idle_poweroff(self, what):
+        with self._switchMutex:
+            policy = self.idlePolicies.get(what)
+            if policy is None or not policy.enabled or not self._isWhatOn(what, ''):
+                return
 
-        self._logger.info("Idle timeout reached after %s minute(s). Turning heaters off prior to shutting off PSU." % self.idleTimeout)
-        if self._wait_for_heaters():
-            self._logger.info("Heaters below temperature.")
-            if self.powerOffPSUWhenIdle:
-                self.turn_psu_off()
-            if self.powerOffLightWhenIdle:
-                self.turn("Light", "Off")
-            if self.powerOffFanWhenIdle:
-                self.turn("Fan", "Off")
+            now = time.time()
+            if policy.after:
+                if self._isWhatOn(policy.after, ''):
+                    return
+                if self._printer.is_printing() or self._printer.is_paused():
+                    self._scheduler.schedule(what, now + self._idleRecheckInterval, self._idle_poweroff, what)
+                    return
+                self._logger.info("Turning %s off %s minute(s) after %s." % (what, policy.afterDelay / 60, policy.after))
+                self._history.event(EVENT_IDLE_POWEROFF)
+                self._journal_event(journal.IDLE_POWEROFF, what, policy.after)
+                if what == 'PSU':
+                    self.turn_psu_off()
+                else:
+                    self.turn(what, "Off")
+                return
 
-        else:
-            self._logger.info("Aborted PSU shut down due to activity.")
+            due = max(self._lastActivity, self._idleArmedAt[what]) + policy.timeout
+            if due > now:
+                if self._idleWaiting.pop(what, None) is not None:
+                    self._logger.info("Aborted %s shut down due to activity." % what)
+                    self._journal_event(journal.IDLE_ABORT, what)
+                self._scheduler.schedule(what, due, self._idle_poweroff, what)
+                return
 
-    def _wait_for_heaters(self):
-        self._waitForHeaters = True
+            if self._printer.is_printing() or self._printer.is_paused():
+                self._scheduler.schedule(what, now + policy.timeout, self._idle_poweroff, what)
+                return
+
+            temps = tool_temperatures(self._printer.get_current_temperatures())
+            self._logger.debug("Heaters: %s", temps)
+            if not heaters_cooled(temps, policy.waitTemp):
+                if what not in self._idleWaiting:
+                    self._idleWaiting[what] = now
+                    self._journal_event(journal.IDLE_WAIT, what, max(list(temps.values()) + [0]))
+                    self._logger.info("Idle timeout reached after %s minute(s) for %s." % (policy.timeout / 60, what))
+                    if policy.heatersOff:
+                        self._logger.info("Turning heaters off prior to shutting off %s." % what)
+                        self._turn_heaters_off()
+
+                heaters_above_waittemp = [heater for heater, temp in temps.items() if temp > policy.waitTemp]
+                self._logger.info("Waiting for heaters(%s) before shutting off %s..." % (', '.join(heaters_above_waittemp), what))
+                self._scheduler.schedule(what, now + self._idleRecheckInterval, self._idle_poweroff, what)
+                return
+
+            self._idleWaiting.pop(what, None)
+            self._logger.info("Idle timeout reached for %s, heaters below temperature." % what)
+            self._history.event(EVENT_IDLE_POWEROFF)
+            self._journal_event(journal.IDLE_POWEROFF, what)
+            if what == 'PSU':
+                self.turn_psu_off()
+            else:
+                self.turn(what, "Off")
+
+    def _turn_heaters_off(self):
         heaters = self._printer.get_current_temperatures()
         
         for heater, entry in heaters.items():
@@ -500,46 +969,95 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
                 self._printer.set_temperature(heater, 0)
                 self._skipIdleTimer = False
             else:
-                self._logger.debug("Heater %s already off." % heater)
+                self._logger.debug("Heater %s already off.", heater)
 
-        while True:
-            if not self._waitForHeaters:
-                return False
-            
-            heaters = self._printer.get_current_temperatures()
-            
-            highest_temp = 0
-            heaters_above_waittemp = []
-            for heater, entry in heaters.items():
-                if not heater.startswith("tool"):
-                    continue
+    def hook_temperatures_received(self, comm_instance, parsed_temperatures, *args, **kwargs):
+        if self._fanRampStart is not None and self.fanRampMode == 'TEMPERATURE':
+            self._scheduler.schedule("FanRamp", 0, self._fan_ramp_step, parsed_tool_temperatures(parsed_temperatures))
 
-                actual = entry.get("actual")
-                if actual is None:
-                    # heater doesn't exist in fw
-                    continue
+        # Channels waiting for heaters to cool down are re-evaluated as soon as they have.
+        if self._idleWaiting:
+            temps = parsed_tool_temperatures(parsed_temperatures)
+            for what in list(self._idleWaiting):
+                policy = self.idlePolicies.get(what)
+                if policy is not None and heaters_cooled(temps, policy.waitTemp):
+                    self._scheduler.schedule(what, 0, self._idle_poweroff, what)
+        return parsed_temperatures
 
-                try:
-                    temp = float(actual)
-                except ValueError:
-                    # not a float for some reason, skip it
-                    continue
-
-                self._logger.debug("Heater %s = %sC" % (heater,temp))
-                if temp > self.idleTimeoutWaitTemp:
-                    heaters_above_waittemp.append(heater)
-                
-                if temp > highest_temp:
-                    highest_temp = temp
-                
-            if highest_temp <= self.idleTimeoutWaitTemp:
-                self._waitForHeaters = False
-                return True
-            
-            self._logger.info("Waiting for heaters(%s) before shutting off PSU..." % ', '.join(heaters_above_waittemp))
-            time.sleep(5)
+    def _scan_job_file(self, origin, path):
+        if origin != "local":
+            return None
+
+        try:
+            filename = self._file_manager.path_on_disk(origin, path)
+            metadata = self._file_manager.get_metadata(origin, path) or dict()
+            key = (file_key(filename, metadata.get("hash")), self.pseudoOnGCodeCommand,
+                   self.pseudoOffGCodeCommand, self.autoOnTriggerGCodeCommands)
+
+            result = self._gcodeScanCache.get(key)
+            if result is None:
+                start = time.time()
+                result = scan_file(filename, self.pseudoOnGCodeCommand, self.pseudoOffGCodeCommand,
+                                   self._autoOnTriggerGCodeCommandsArray)
+                self._gcodeScanCache.put(key, result)
+                self._logger.debug("Scanned %s in %.2fs: %s", path, time.time() - start, result)
+        except (IOError, OSError) as e:
+            self._logger.warning("Could not scan %s: %s" % (path, e))
+            return None
+
+        if origin == self._jobOrigin and path == self._jobPath:
+            self._jobScan = result
+            self._update_job_fast_path()
+        return result
+
+    def _start_job_scan(self, origin, path):
+        # One worker scans queued files in turn. A file that is already queued or
+        # being scanned, e.g. uploaded and selected at once, isn't queued again.
+        if origin != "local" or not path or not valid_file_type(path, type="machinecode"):
+            return
+        with self._jobScanMutex:
+            if (origin, path) in self._jobScanQueue:
+                return
+            self._jobScanQueue.append((origin, path))
+            if self._jobScanThread is None:
+                self._jobScanThread = threading.Thread(target=self._run_job_scans)
+                self._jobScanThread.daemon = True
+                self._jobScanThread.start()
+
+    def _run_job_scans(self):
+        while True:
+            with self._jobScanMutex:
+                if not self._jobScanQueue:
+                    self._jobScanThread = None
+                    return
+                origin, path = self._jobScanQueue[0]
+            try:
+                self._scan_job_file(origin, path)
+            finally:
+                with self._jobScanMutex:
+                    self._jobScanQueue.pop(0)
+
+    def _set_job(self, origin, path):
+        self._jobOrigin = origin
+        self._jobPath = path
+        self._jobScan = None
+        self._update_job_fast_path()
+        if path is not None:
+            self._start_job_scan(origin, path)
+
+    def _update_job_fast_path(self):
+        scan = self._jobScan
+        self._jobFastPath = (scan is not None and
+                             not (self.enablePseudoOnOff and (scan["pseudoOn"] or scan["pseudoOff"])))
 
     def hook_gcode_queuing(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+        # Lines streamed from a job that was scanned clean need no checks once the PSU is on.
+        # The idle timer is reset when the job ends instead.
+        if self._jobFastPath and not self._psu_needs_on():
+            tags = kwargs.get("tags")
+            if tags and "source:file" in tags:
+                return
+
         skipQueuing = False
 
         if gcode:
@@ -553,98 +1071,221 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
                     comm_instance._log("PSUControl: ok")
                     skipQueuing = True
 
-            if (not self.isPSUOn() and self.autoOn and (gcode in self._autoOnTriggerGCodeCommandsArray)):
-                self._logger.info("Auto-On - Turning PSU On (Triggered by %s)" % gcode)
-                self.turn_psu_on()
+            if (self._psu_needs_on() and self.autoOn and triggers_auto_on(gcode, self._autoOnTriggerGCodeCommandsArray)):
+                switch = self._coordinator_power_on()
+                with self._switchMutex:
+                    # Another thread may have powered on while we waited.
+                    if self._psu_needs_on():
+                        self._logger.info("Auto-On - Turning PSU On (Triggered by %s)", gcode)
+                        self._journal_event(journal.AUTO_ON, "PSU", gcode)
+                        self.turn_psu_on(switch)
+                    else:
+                        self._abandon_power_on()
+
+            if (self._preArmedAt is not None and not self._preArming and
+                    triggers_auto_on(gcode, self._autoOnTriggerGCodeCommandsArray)):
+                self._clear_pre_arm()
 
             if self.powerOffWhenIdle and self.isPSUOn() and not self._skipIdleTimer:
-                if not (gcode in self._idleIgnoreCommandsArray):
-                    self._waitForHeaters = False
-                    self._reset_idle_timer()
+                if resets_idle_timer(gcode, self._idleIgnoreCommandsArray):
+                    self._idle_activity()
 
             if skipQueuing:
                 return (None,)
 
+    def _start_pre_arm(self, event):
+        if self._preArmedAt is not None or not self._psu_needs_on() or self._printer.is_printing():
+            return
+        self._preArmedAt = time.time()
+        t = threading.Thread(target=self._pre_arm, args=(event, self._preArmedAt))
+        t.daemon = True
+        t.start()
+
+    def _pre_arm_pending(self, armedAt):
+        with self._switchMutex:
+            # Cleared in the meantime by a print start, a trigger command or a manual switch.
+            if self._preArmedAt != armedAt:
+                return False
+            if not self._psu_needs_on():
+                self._preArmedAt = None
+                return False
+            return True
+
+    def _pre_arm(self, event, armedAt):
+        if not self._pre_arm_pending(armedAt):
+            return
+        switch = self._coordinator_power_on()
+        with self._switchMutex:
+            if not self._pre_arm_pending(armedAt):
+                self._abandon_power_on()
+                return
+
+            self._logger.info("Pre-arming - Turning PSU On (Triggered by %s)", event)
+            self._journal_event(journal.PRE_ARM, "PSU", event)
+            # Commands sent by the power-on sequence itself, e.g. the post-on script, aren't user activity.
+            self._preArming = True
+            try:
+                self.turn_psu_on(switch)
+                if self._printer.is_closed_or_error():
+                    self._printer.connect()
+            finally:
+                self._preArming = False
+            if self._preArmedAt != armedAt:
+                return
+            self._scheduler.schedule("PreArm", time.time() + self.preArmWindow * 60, self._pre_arm_expired, armedAt)
+
+    def _pre_arm_expired(self, armedAt):
+        with self._switchMutex:
+            if self._preArmedAt != armedAt:
+                return
+            self._preArmedAt = None
+            if self._printer.is_printing() or self._printer.is_paused() or not self.isPSUOn():
+                return
+
+            self._logger.info("No print started within %s minute(s) of pre-arming, turning PSU off." % self.preArmWindow)
+            self._journal_event(journal.PRE_ARM_CANCEL, "PSU")
+            self.turn_psu_off()
+
+    def _clear_pre_arm(self):
+        # From here on the PSU is left to the idle timer.
+        if self._preArmedAt is not None:
+            self._preArmedAt = None
+            if self._scheduler is not None:
+                self._scheduler.cancel("PreArm")
+
+    def _psu_needs_on(self):
+        # A held lease alone isn't enough: the PSU may have been cut behind the coordinator's back.
+        if self._coordinator is not None and "PSU" not in self._coordinatorLeases:
+            return True
+        return not self.isPSUOn()
+
     def turn(self, what, how):
         if not self._hasGPIO:
             return
-        condition4high = (how=='On' and not self.invertonoffGPIOPin[what])  or (how=='Off' and self.invertonoffGPIOPin[what])
-        pin_output= GPIO.HIGH if  condition4high else GPIO.LOW
-        params = (GPIO.HIGH, GPIO.LOW, what, how, self.onoffGPIOPin[what], pin_output)
-        self._logger.debug("Switching between high(%d) and low(%d): %s %s using GPIO: %s --> %d" % params)
+        with self._switchMutex:
+            if what != "PSU" and self._coordinator is not None:
+                if how == 'On':
+                    switch = self._coordinator_acquire(what)
+                else:
+                    switch = self._coordinator_release(what)
+                if not switch:
+                    self._isWhatOn(what, how)
+                    self._reset_sense_filter(what, how)
+                    self._idle_state_changed(what)
+                    self._check_all_state()
+                    return
+            condition4high = (how=='On' and not self.invertonoffGPIOPin[what])  or (how=='Off' and self.invertonoffGPIOPin[what])
+            pin_output= GPIO.HIGH if  condition4high else GPIO.LOW
+            params = (GPIO.HIGH, GPIO.LOW, what, how, self.onoffGPIOPin[what], pin_output)
+            self._logger.debug("Switching between high(%d) and low(%d): %s %s using GPIO: %s --> %d", *params)
 
-        try:
-            GPIO.output(self._gpio_get_pin(self.onoffGPIOPin[what]), pin_output)
-            self._isWhatOn(what, how)
-            if what != "PSU":
-               self._check_all_state()
-        except (RuntimeError, ValueError) as e:
-            self._logger.error(e)
+            try:
+                if what == "Fan" and self._fanPWMOutput is not None:
+                    # Start at the on duty so the fan spins up before a ramp slows it down.
+                    self._fanPWMOutput.set_duty(self.fanPWMDuty if how == 'On' else 0)
+                else:
+                    GPIO.output(self._gpio_get_pin(self.onoffGPIOPin[what]), pin_output)
+                self._reset_sense_filter(what, how)
+                if self._isWhatOn(what, '') != (how == 'On'):
+                    self._isWhatOn(what, how)
+                    self._idle_state_changed(what)
+                if what == "Fan" and self._fanPWMOutput is not None:
+                    if how == 'On':
+                        self._start_fan_ramp()
+                    else:
+                        self._stop_fan_ramp()
+                if what != "PSU":
+                   self._journal_event(journal.SWITCH, what, how)
+                   self._check_all_state()
+            except (RuntimeError, ValueError) as e:
+                self._logger.error(e)
 
 
-    def turn_psu_on(self):
+    def turn_psu_on(self, switch=None):
+        # Callers holding the switch lock wait for _coordinator_power_on() before
+        # taking it and pass its result as `switch`.
         if self.switchingMethod == 'GCODE' or self.switchingMethod == 'GPIO' or self.switchingMethod == 'SYSTEM':
-            self._logger.info("Switching PSU On")
-            if self.switchingMethod == 'GCODE':
-                self._logger.debug("Switching PSU On Using GCODE: %s" % self.onGCodeCommand)
-                self._printer.commands(self.onGCodeCommand)
-            elif self.switchingMethod == 'SYSTEM':
-                self._logger.debug("Switching PSU On Using SYSTEM: %s" % self.onSysCommand)
-
-                p = subprocess.Popen(self.onSysCommand, shell=True)
-                self._logger.debug("On system command executed. PID=%s, Command=%s" % (p.pid, self.onSysCommand))
-                while p.poll() is None:
-                    time.sleep(0.1)
-                r = p.returncode
+            if switch is None:
+                switch = self._coordinator_power_on()
+            with self._switchMutex:
+                self._logger.info("Switching PSU On")
+                self._journal_event(journal.SWITCH, "PSU", "On")
+                if not switch and self.sensingMethod in ('GPIO','SYSTEM'):
+                    self._sense_all_state()
+                    if not self.isPSUOn():
+                        self._logger.warning("PSU is leased by other instances but sensed off, switching it on")
+                        switch = True
+                if switch:
+                    if self.switchingMethod == 'GCODE':
+                        self._logger.debug("Switching PSU On Using GCODE: %s", self.onGCodeCommand)
+                        self._printer.commands(self.onGCodeCommand)
+                    elif self.switchingMethod == 'SYSTEM':
+                        self._logger.debug("Switching PSU On Using SYSTEM: %s", self.onSysCommand)
+
+                        p = subprocess.Popen(self.onSysCommand, shell=True)
+                        self._logger.debug("On system command executed. PID=%s, Command=%s", p.pid, self.onSysCommand)
+                        while p.poll() is None:
+                            time.sleep(0.1)
+                        r = p.returncode
+
+                        self._logger.debug("On system command returned: %s", r)
+                    elif self.switchingMethod == 'GPIO':
+                        self.turn("PSU", "On")
+                self._reset_sense_filter("PSU", "On")
+
+                if self.sensingMethod not in ('GPIO','SYSTEM'):
+                    self._noSensing_isPSUOn = True
+         
+                time.sleep(0.1 + (self.postOnDelay if switch else 0))
 
-                self._logger.debug("On system command returned: %s" % r)
-            elif self.switchingMethod == 'GPIO':
-                self.turn("PSU", "On")
+                if switch:
+                    self._coordinator_request("powered", channel="PSU")
 
-            if self.sensingMethod not in ('GPIO','SYSTEM'):
-                self._noSensing_isPSUOn = True
-         
-            time.sleep(0.1 + self.postOnDelay)
+                self._sense_all_state()
 
-            self.check_psu_state()
+                if self.connectOnPowerOn and self._printer.is_closed_or_error():
+                    self._printer.connect()
+                    time.sleep(0.1)
 
-            if self.connectOnPowerOn and self._printer.is_closed_or_error():
-                self._printer.connect()
-                time.sleep(0.1)
+                self._power_on_slot_done()
 
-            if not self._printer.is_closed_or_error():
-                self._printer.script("psucontrol_post_on", must_be_set=False)
+                if not self._printer.is_closed_or_error():
+                    self._printer.script("psucontrol_post_on", must_be_set=False)
         
     def turn_psu_off(self):
         if self.switchingMethod == 'GCODE' or self.switchingMethod == 'GPIO' or self.switchingMethod == 'SYSTEM':
-            if not self._printer.is_closed_or_error():
-                self._printer.script("psucontrol_pre_off", must_be_set=False)
+            with self._switchMutex:
+                if not self._printer.is_closed_or_error():
+                    self._printer.script("psucontrol_pre_off", must_be_set=False)
             
-            self._logger.info("Switching PSU Off")
-            if self.switchingMethod == 'GCODE':
-                self._logger.debug("Switching PSU Off Using GCODE: %s" % self.offGCodeCommand)
-                self._printer.commands(self.offGCodeCommand)
-            elif self.switchingMethod == 'SYSTEM':
-                self._logger.debug("Switching PSU Off Using SYSTEM: %s" % self.offSysCommand)
-
-                p = subprocess.Popen(self.offSysCommand, shell=True)
-                self._logger.debug("Off system command executed. PID=%s, Command=%s" % (p.pid, self.offSysCommand))
-                while p.poll() is None:
-                    time.sleep(0.1)
-                r = p.returncode
-
-                self._logger.debug("Off system command returned: %s" % r)
-            elif self.switchingMethod == 'GPIO':
-                self.turn("PSU", "Off")
-
-            if self.disconnectOnPowerOff:
-                self._printer.disconnect()
+                self._logger.info("Switching PSU Off")
+                self._journal_event(journal.SWITCH, "PSU", "Off")
+                if self._coordinator_release("PSU"):
+                    if self.switchingMethod == 'GCODE':
+                        self._logger.debug("Switching PSU Off Using GCODE: %s", self.offGCodeCommand)
+                        self._printer.commands(self.offGCodeCommand)
+                    elif self.switchingMethod == 'SYSTEM':
+                        self._logger.debug("Switching PSU Off Using SYSTEM: %s", self.offSysCommand)
+
+                        p = subprocess.Popen(self.offSysCommand, shell=True)
+                        self._logger.debug("Off system command executed. PID=%s, Command=%s", p.pid, self.offSysCommand)
+                        while p.poll() is None:
+                            time.sleep(0.1)
+                        r = p.returncode
+
+                        self._logger.debug("Off system command returned: %s", r)
+                    elif self.switchingMethod == 'GPIO':
+                        self.turn("PSU", "Off")
+                    self._reset_sense_filter("PSU", "Off")
+
+                if self.disconnectOnPowerOff:
+                    self._printer.disconnect()
                 
-            if self.sensingMethod not in ('GPIO','SYSTEM'):
-                self._noSensing_isPSUOn = False
+                if self.sensingMethod not in ('GPIO','SYSTEM'):
+                    self._noSensing_isPSUOn = False
                         
-            time.sleep(0.1)
-            self.check_psu_state()
+                time.sleep(0.1)
+                self._sense_all_state()
 
     def on_event(self, event, payload):
         if event == Events.CLIENT_OPENED:
@@ -655,6 +1296,30 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
                 isFanOn=self.isFanOn()))
             return
 
+        if self.preArmEnabled and event in self._preArmEventsArray:
+            self._start_pre_arm(event)
+
+        if event == Events.PRINT_STARTED:
+            self._clear_pre_arm()
+
+        if event == Events.UPLOAD:
+            self._start_job_scan(payload.get("target"), payload.get("path"))
+        elif event in (Events.FILE_SELECTED, Events.PRINT_STARTED):
+            if (payload.get("origin"), payload.get("path")) != (self._jobOrigin, self._jobPath):
+                self._set_job(payload.get("origin"), payload.get("path"))
+        elif event == Events.FILE_DESELECTED:
+            self._set_job(None, None)
+        elif event in (Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
+            self._idle_activity()
+
+        if self._fanPWMOutput is not None and self.isFanOn():
+            if event == Events.PRINT_STARTED and self.fanRampMode == 'TIME':
+                with self._switchMutex:
+                    self._stop_fan_ramp()
+                    self._fanPWMOutput.set_duty(self.fanPWMDuty)
+            elif event in (Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
+                self._start_fan_ramp()
+
     def get_api_commands(self):
         return dict(
             turnPSUOn=[],
@@ -666,11 +1331,71 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
             turnFanOn=[],
             turnFanOff=[],
             toggleFan=[],
-            getAllState=[]
+            getAllState=[],
+            getSenseSnapshot=[],
+            getHistory=[],
+            getJournal=[],
+            getPowerOnQueue=[],
+            getBulkState=[],
+            setFanDuty=["duty"]
         )
 
     def on_api_get(self, request):
-        return self.on_api_command("getAllState", [])
+        if not user_permission.can():
+            return make_response("Insufficient rights", 403)
+        bulk = request.args.get("bulk", "").lower() in ("1", "true", "yes")
+        return self._state_response(bulk, request.headers.get("If-None-Match"))
+
+    def _state_response(self, bulk, if_none_match=None):
+        # Pollers get a body serialized once per state change and 304 while their ETag is current.
+        state = dict(
+            isPSUOn=self.isPSUOn(),
+            isLightOn=self.isLightOn(),
+            isFanOn=self.isFanOn(),
+            fanDuty=self._fanPWMOutput.duty if self._fanPWMOutput is not None else None)
+        cache = self._stateCache
+        if bulk:
+            state["idle"] = dict((fn, dict(enabled=policy.enabled,
+                                           deadline=self._idle_deadline(fn),
+                                           coolingDownSince=self._idleWaiting.get(fn)))
+                                 for fn, policy in self.idlePolicies.items())
+            state["preArmedAt"] = self._preArmedAt
+            cache = self._bulkStateCache
+
+        version, etag, body = cache.get(state)
+        if etag_matches(if_none_match, etag):
+            response = make_response("", 304)
+        else:
+            response = make_response(body)
+            response.headers["Content-Type"] = "application/json"
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    def _switch(self, what, how):
+        # The toggle decision is made under the same lock as the switch it leads to,
+        # except that powering the PSU on first waits for the coordinator without
+        # the lock. A toggle another switch of this instance overtook meanwhile is dropped.
+        with self._switchMutex:
+            if what == 'PSU':
+                self._clear_pre_arm()
+            toggled = how == 'Toggle'
+            if toggled:
+                how = 'Off' if self._isWhatOn(what, '') else 'On'
+            if what!='PSU':
+               self.turn(what, how)
+               return
+            if how!='On':
+               if how=='Off':
+                  self.turn_psu_off()
+               return
+
+        switch = self._coordinator_power_on()
+        with self._switchMutex:
+            if toggled and switch and self.isPSUOn():
+                self._abandon_power_on()
+                return
+            self.turn_psu_on(switch)
 
     def on_api_command(self, command, data):
         if not user_permission.can():
@@ -686,24 +1411,63 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
             elif command[4:7]=='Fan':
                what='Fan'
                how=command[7:]
-            if what=='PSU':
-               if how=='On':
-                  self.turn_psu_on()
-               elif how=='Off':
-                  self.turn_psu_off()
-               else:
-                  if self.isPSUOn():
-                     self.turn_psu_off()
-                  else:
-                     self.turn_psu_on()
-            else:
-               self.turn(what, how)
-            #self.sense_all_state()
+            self._switch(what, how)
+        elif command[:6]=='toggle':
+            self._switch(command[6:], 'Toggle')
         elif command == 'getAllState':
             return jsonify(
                 isPSUOn=self.isPSUOn(),
                 isLightOn=self.isLightOn(),
-                isFanOn=self.isFanOn())
+                isFanOn=self.isFanOn(),
+                fanDuty=self._fanPWMOutput.duty if self._fanPWMOutput is not None else None)
+        elif command == 'getBulkState':
+            return self._state_response(True)
+        elif command == 'setFanDuty':
+            if self._fanPWMOutput is None:
+                return make_response("Fan PWM is not configured", 409)
+            try:
+                duty = float(data["duty"])
+            except (TypeError, ValueError):
+                return make_response("Invalid duty", 400)
+            self._set_fan_duty(duty)
+            return jsonify(fanDuty=self._fanPWMOutput.duty)
+        elif command == 'getSenseSnapshot':
+            snapshot = self._senseSnapshot
+            filters = dict((fn, f.stats()) for fn, f in self._senseFilters.items() if f.state is not None)
+            if snapshot is None:
+                return jsonify(batched=False, timestamp=None, values=dict(), duration=None, filters=filters)
+            return jsonify(
+                batched=self._senseReader is not None and self._senseReader.batched,
+                timestamp=snapshot.timestamp,
+                values=snapshot.values,
+                duration=snapshot.duration,
+                filters=filters)
+        elif command == 'getHistory':
+            try:
+                end = float(data.get("end", time.time()))
+                start = float(data.get("start", end - 24 * 3600))
+            except (TypeError, ValueError):
+                return make_response("Invalid start or end", 400)
+            return jsonify(self._history.summary(start, end, series=bool(data.get("series", False))))
+        elif command == 'getJournal':
+            if self._journal is None:
+                return make_response("Event journal is disabled", 409)
+            try:
+                since = float(data["since"]) if "since" in data else None
+                until = float(data["until"]) if "until" in data else None
+                limit = int(data["limit"]) if "limit" in data else None
+            except (TypeError, ValueError):
+                return make_response("Invalid since, until or limit", 400)
+            kinds = data.get("kinds")
+            if kinds and not isinstance(kinds, list):
+                kinds = kinds.split(',')
+            return jsonify(events=self._journal.query(since, until, kinds, data.get("channel"), limit))
+        elif command == 'getPowerOnQueue':
+            queue = self._coordinator_request("queue") if self.staggerPowerOn else None
+            return jsonify(
+                staggerPowerOn=self.staggerPowerOn and self._coordinator is not None,
+                admission=self._powerOnAdmission,
+                queue=queue)
 
 
     def get_settings_defaults(self):
@@ -726,12 +1490,31 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
             disconnectOnPowerOff = False,
             sensingMethod = 'INTERNAL',
             senseGPIOPin = 0,
+            senseLightGPIOPin = 0,
+            senseFanGPIOPin = 0,
+            senseGPIOChip = 'gpiochip0',
             sensePollingInterval = 5,
             invertsenseGPIOPin = False,
             senseGPIOPinPUD = '',
             senseSystemCommand = '',
+            senseFilterEnabled = False,
+            senseFilterWindow = 5,
+            senseFilterHysteresis = 1,
+            senseFilterDwell = 0.0,
+            powerPSUWatts = 0.0,
+            powerLightWatts = 0.0,
+            powerFanWatts = 0.0,
+            fanPWM = False,
+            fanPWMFrequency = 1000,
+            fanPWMHardware = True,
+            fanPWMDuty = 100.0,
+            fanRampMode = 'NONE',
+            fanRampProfile = '',
             autoOn = False,
             autoOnTriggerGCodeCommands = "G0,G1,G2,G3,G10,G11,G28,G29,G32,M104,M106,M109,M140,M190",
+            preArmEnabled = False,
+            preArmEvents = "Upload,FileSelected",
+            preArmWindow = 5,
             enablePowerOffWarningDialog = True,
             powerOffWhenIdle = False,
             powerOffPSUWhenIdle = False,
@@ -739,7 +1522,27 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
             powerOffLightWhenIdle = False,
             idleTimeout = 30,
             idleIgnoreCommands = 'M105',
-            idleTimeoutWaitTemp = 50
+            idleTimeoutWaitTemp = 50,
+            idlePSUTimeout = -1,
+            idleLightTimeout = -1,
+            idleFanTimeout = -1,
+            idlePSUWaitTemp = -1,
+            idleLightWaitTemp = -1,
+            idleFanWaitTemp = -1,
+            idlePSUHeatersOff = True,
+            idleLightHeatersOff = True,
+            idleFanHeatersOff = True,
+            idleLightAfter = '',
+            idleFanAfter = '',
+            idleLightAfterDelay = 0,
+            idleFanAfterDelay = 0,
+            journalEnabled = False,
+            coordinatorEnabled = False,
+            coordinatorSocket = '/tmp/psucontrol_plus.sock',
+            coordinatorClientId = '',
+            coordinatorLeaseTTL = 60,
+            staggerPowerOn = False,
+            coordinatorPowerOnTimeout = 120
         )
 
     def on_settings_save(self, data):
@@ -747,9 +1550,18 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
         old_onoffGPIOPin = self.onoffGPIOPin
         old_sensingMethod = self.sensingMethod
         old_senseGPIOPin = self.senseGPIOPin
+        old_senseLightGPIOPin = self.senseLightGPIOPin
+        old_senseFanGPIOPin = self.senseFanGPIOPin
+        old_senseGPIOChip = self.senseGPIOChip
+        old_lightEnabled = self.lightEnabled
+        old_fanEnabled = self.fanEnabled
         old_invertsenseGPIOPin = self.invertsenseGPIOPin
         old_senseGPIOPinPUD = self.senseGPIOPinPUD
         old_switchingMethod = self.switchingMethod
+        old_invertonoffGPIOPin = self.invertonoffGPIOPin
+        old_fanPWM = self.fanPWM
+        old_fanPWMFrequency = self.fanPWMFrequency
+        old_fanPWMHardware = self.fanPWMHardware
 
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
         
@@ -777,22 +1589,51 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
         self.disconnectOnPowerOff = self._settings.get_boolean(["disconnectOnPowerOff"])
         self.sensingMethod = self._settings.get(["sensingMethod"])
         self.senseGPIOPin = self._settings.get_int(["senseGPIOPin"])
+        self.senseLightGPIOPin = self._settings.get_int(["senseLightGPIOPin"])
+        self.senseFanGPIOPin = self._settings.get_int(["senseFanGPIOPin"])
+        self.senseGPIOChip = self._settings.get(["senseGPIOChip"])
+        self.lightEnabled = self._settings.get_boolean(["lightEnabled"])
+        self.fanEnabled = self._settings.get_boolean(["fanEnabled"])
+        self._load_fan_pwm()
         self.sensePollingInterval = self._settings.get_int(["sensePollingInterval"])
         self.invertsenseGPIOPin = self._settings.get_boolean(["invertsenseGPIOPin"])
         self.senseGPIOPinPUD = self._settings.get(["senseGPIOPinPUD"])
         self.senseSystemCommand = self._settings.get(["senseSystemCommand"])
+        self.senseFilterEnabled = self._settings.get_boolean(["senseFilterEnabled"])
+        self.senseFilterWindow = self._settings.get_int(["senseFilterWindow"])
+        self.senseFilterHysteresis = self._settings.get_int(["senseFilterHysteresis"])
+        self.senseFilterDwell = self._settings.get_float(["senseFilterDwell"])
+        self._configure_sense_filters()
+        self.powerWatts = {
+            "PSU": self._settings.get_float(["powerPSUWatts"]),
+            "Light": self._settings.get_float(["powerLightWatts"]),
+            "Fan": self._settings.get_float(["powerFanWatts"])
+        }
         self.autoOn = self._settings.get_boolean(["autoOn"])
         self.autoOnTriggerGCodeCommands = self._settings.get(["autoOnTriggerGCodeCommands"])
         self._autoOnTriggerGCodeCommandsArray = self.autoOnTriggerGCodeCommands.split(',')
+        self.preArmEnabled = self._settings.get_boolean(["preArmEnabled"])
+        self.preArmEvents = self._settings.get(["preArmEvents"])
+        self._preArmEventsArray = [e.strip() for e in self.preArmEvents.split(',') if e.strip()]
+        self.preArmWindow = self._settings.get_int(["preArmWindow"])
+        if not self.preArmEnabled:
+            self._clear_pre_arm()
         self.powerOffWhenIdle = self._settings.get_boolean(["powerOffWhenIdle"])
-        self.powerOffPSUWhenIdle = self._settings.get_boolean(["powerOffPSUWhenIdle"])
-        self.powerOffLightWhenIdle = self._settings.get_boolean(["powerOffLightWhenIdle"])
-        self.powerOffFanWhenIdle = self._settings.get_boolean(["powerOffFanWhenIdle"])
         self.idleTimeout = self._settings.get_int(["idleTimeout"])
         self.idleIgnoreCommands = self._settings.get(["idleIgnoreCommands"])
         self.enablePowerOffWarningDialog = self._settings.get_boolean(["enablePowerOffWarningDialog"])
         self._idleIgnoreCommandsArray = self.idleIgnoreCommands.split(',')
         self.idleTimeoutWaitTemp = self._settings.get_int(["idleTimeoutWaitTemp"])
+        self._load_idle_policies()
+        self.journalEnabled = self._settings.get_boolean(["journalEnabled"])
+        self._configure_journal()
+        self.coordinatorEnabled = self._settings.get_boolean(["coordinatorEnabled"])
+        self.coordinatorSocket = self._settings.get(["coordinatorSocket"])
+        self.coordinatorClientId = self._settings.get(["coordinatorClientId"])
+        self.coordinatorLeaseTTL = self._settings.get_int(["coordinatorLeaseTTL"])
+        self.staggerPowerOn = self._settings.get_boolean(["staggerPowerOn"])
+        self.coordinatorPowerOnTimeout = self._settings.get_int(["coordinatorPowerOnTimeout"])
+        self._configure_coordinator()
 
         if 'scripts_gcode_psucontrol_post_on' in data:
             script = data["scripts_gcode_psucontrol_post_on"]
@@ -814,6 +1655,15 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
              old_onoffGPIOPin["Fan"] != self.onoffGPIOPin["Fan"] or
              old_onoffGPIOPin["Light"] != self.onoffGPIOPin["Light"] or
              old_senseGPIOPin != self.senseGPIOPin or
+             old_senseLightGPIOPin != self.senseLightGPIOPin or
+             old_senseFanGPIOPin != self.senseFanGPIOPin or
+             old_senseGPIOChip != self.senseGPIOChip or
+             old_lightEnabled != self.lightEnabled or
+             old_fanEnabled != self.fanEnabled or
+             old_invertonoffGPIOPin["Fan"] != self.invertonoffGPIOPin["Fan"] or
+             old_fanPWM != self.fanPWM or
+             old_fanPWMFrequency != self.fanPWMFrequency or
+             old_fanPWMHardware != self.fanPWMHardware or
              old_sensingMethod != self.sensingMethod or
              old_invertsenseGPIOPin != self.invertsenseGPIOPin or
              old_senseGPIOPinPUD != self.senseGPIOPinPUD or
@@ -821,6 +1671,7 @@ class PSUControlPlus(octoprint.plugin.StartupPlugin,
             (self.switchingMethod == 'GPIO' or self.sensingMethod == 'GPIO')):
             self._configure_gpio()
 
+        self._set_job(self._jobOrigin, self._jobPath)
         self._start_idle_timer()
 
     def get_settings_version(self):
@@ -903,5 +1754,6 @@ def __plugin_load__():
     global __plugin_hooks__
     __plugin_hooks__ = {
         "octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.hook_gcode_queuing,
+        "octoprint.comm.protocol.temperatures.received": __plugin_implementation__.hook_temperatures_received,
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information
     }
@@ -0,0 +1,351 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Local coordinator shared by several OctoPrint instances on one host.
+#
+# The daemon keeps leases per channel (PSU, Light, Fan). An instance acquires
+# a lease before powering a channel on and releases it when it wants the
+# channel off. Only the first lessee switches the channel on and only the last
+# one switches it off, so one printer's idle timeout never cuts power to a
+# printer that is still busy. The first lessee marks the channel powered once
+# its power-on sequence is done; later lessees wait for that before using it.
+#
+# The daemon also admits PSU power-ons one after the other: at most
+# --power-on-concurrency instances may be in their power-on sequence at the
+# same time, and switch-ons are spaced by at least --power-on-spacing seconds.
+# This caps inrush current and keeps USB enumeration from piling up.
+#
+# Protocol: one JSON object per line over a Unix stream socket, one request
+# per connection.
+#
+#   python -m octoprint_psucontrol_plus.coordinator --socket /tmp/psucontrol_plus.sock
+
+import argparse
+import errno
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+DEFAULT_SOCKET = "/tmp/psucontrol_plus.sock"
+DEFAULT_SOCKET_MODE = 0o660
+
+
+class CoordinatorError(Exception):
+    pass
+
+
+class LeaseTable(object):
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._leases = dict()
+        self._powered = set()
+
+    def _purge(self, now):
+        for channel, holders in self._leases.items():
+            for client, expires in list(holders.items()):
+                if expires and expires < now:
+                    del holders[client]
+            if not holders:
+                self._powered.discard(channel)
+
+    def acquire(self, client, channel, ttl=0):
+        now = time.time()
+        with self._mutex:
+            self._purge(now)
+            holders = self._leases.setdefault(channel, dict())
+            others = [c for c in holders if c != client]
+            holders[client] = now + ttl if ttl else 0
+            return dict(first=(len(others) == 0), holders=len(holders), powered=(channel in self._powered))
+
+    def release(self, client, channel):
+        now = time.time()
+        with self._mutex:
+            self._purge(now)
+            holders = self._leases.setdefault(channel, dict())
+            holders.pop(client, None)
+            if not holders:
+                self._powered.discard(channel)
+            return dict(last=(len(holders) == 0), holders=len(holders))
+
+    def set_powered(self, client, channel):
+        # The first lessee reports the channel usable once its power-on sequence is done.
+        with self._mutex:
+            if client in self._leases.get(channel, dict()):
+                self._powered.add(channel)
+            return dict(powered=(channel in self._powered))
+
+    def renew(self, client, channels, ttl=0, powered=()):
+        now = time.time()
+        with self._mutex:
+            self._purge(now)
+            # Leases lost to a daemon restart or an expiry are taken again, so
+            # another instance's release can't switch off a channel still in use.
+            renewed = []
+            reacquired = []
+            for channel in channels:
+                holders = self._leases.setdefault(channel, dict())
+                if client in holders:
+                    renewed.append(channel)
+                else:
+                    reacquired.append(channel)
+                holders[client] = now + ttl if ttl else 0
+                if channel in powered:
+                    self._powered.add(channel)
+            return dict(renewed=renewed, reacquired=reacquired)
+
+    def status(self):
+        with self._mutex:
+            self._purge(time.time())
+            return dict(leases=dict((channel, sorted(holders.keys()))
+                                    for channel, holders in self._leases.items()),
+                        powered=sorted(self._powered))
+
+
+class AdmissionQueue(object):
+    # Waiting clients are dropped when they stop polling for this long.
+    poll_timeout = 10.0
+
+    def __init__(self, concurrency=1, spacing=0.0, hold_timeout=60.0):
+        self._mutex = threading.Lock()
+        self.concurrency = max(1, concurrency)
+        self.spacing = spacing
+        self.hold_timeout = hold_timeout
+        self._waiting = []
+        self._polled = dict()
+        self._active = dict()
+        self._lastGrant = 0
+        self._avgHold = spacing
+
+    def _purge(self, now):
+        for client, expires in list(self._active.items()):
+            if expires < now:
+                del self._active[client]
+        for client in list(self._waiting):
+            if self._polled.get(client, 0) + self.poll_timeout < now:
+                self._waiting.remove(client)
+                self._polled.pop(client, None)
+
+    def _eta(self, position, now):
+        wait = max(0, self._lastGrant + self.spacing - now)
+        if len(self._active) >= self.concurrency:
+            started = min(expires - self.hold_timeout for expires in self._active.values())
+            wait = max(wait, started + self._avgHold - now)
+        return wait + position * max(self.spacing, self._avgHold / self.concurrency)
+
+    def admit(self, client):
+        now = time.time()
+        with self._mutex:
+            self._purge(now)
+            if client in self._active:
+                return dict(granted=True, position=0, eta=0)
+
+            if client not in self._waiting:
+                self._waiting.append(client)
+            self._polled[client] = now
+
+            position = self._waiting.index(client)
+            if (position == 0 and len(self._active) < self.concurrency and
+                    now >= self._lastGrant + self.spacing):
+                self._waiting.pop(0)
+                self._polled.pop(client, None)
+                self._active[client] = now + self.hold_timeout
+                self._lastGrant = now
+                return dict(granted=True, position=0, eta=0)
+
+            return dict(granted=False, position=position + 1, eta=round(self._eta(position, now), 1))
+
+    def done(self, client):
+        now = time.time()
+        with self._mutex:
+            expires = self._active.pop(client, None)
+            if expires is not None:
+                held = now - (expires - self.hold_timeout)
+                self._avgHold = 0.8 * self._avgHold + 0.2 * held
+            if client in self._waiting:
+                self._waiting.remove(client)
+                self._polled.pop(client, None)
+            return dict(active=len(self._active))
+
+    def status(self):
+        now = time.time()
+        with self._mutex:
+            self._purge(now)
+            return dict(concurrency=self.concurrency,
+                        spacing=self.spacing,
+                        active=sorted(self._active.keys()),
+                        waiting=[dict(client=client, position=i + 1, eta=round(self._eta(i, now), 1))
+                                 for i, client in enumerate(self._waiting)])
+
+
+class Coordinator(object):
+    def __init__(self, admission=None):
+        self.leases = LeaseTable()
+        self.admission = admission or AdmissionQueue()
+
+    def handle(self, request):
+        op = request.get("op")
+        client = request.get("client", "")
+        channel = request.get("channel", "PSU")
+        ttl = float(request.get("ttl", 0) or 0)
+
+        if op == "acquire":
+            return self.leases.acquire(client, channel, ttl)
+        elif op == "release":
+            return self.leases.release(client, channel)
+        elif op == "renew":
+            return self.leases.renew(client, request.get("channels", []), ttl, request.get("powered", []))
+        elif op == "powered":
+            return self.leases.set_powered(client, channel)
+        elif op == "status":
+            return self.leases.status()
+        elif op == "admit":
+            return self.admission.admit(client)
+        elif op == "done":
+            return self.admission.done(client)
+        elif op == "queue":
+            return self.admission.status()
+        else:
+            return dict(error="Unknown op: %s" % op)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        try:
+            response = self.server.coordinator.handle(json.loads(line.decode("utf-8")))
+        except (ValueError, TypeError) as e:
+            response = dict(error=str(e))
+
+        self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+
+def _socket_alive(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error as e:
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            return False
+        raise
+    finally:
+        sock.close()
+
+
+class CoordinatorServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, coordinator=None, mode=DEFAULT_SOCKET_MODE, group=None):
+        # A second daemon on the same path would split the lease table, so only
+        # a stale socket left behind by a dead one is replaced.
+        if os.path.exists(path):
+            if _socket_alive(path):
+                raise CoordinatorError("A coordinator is already listening on %s" % path)
+            os.unlink(path)
+        self.coordinator = coordinator or Coordinator()
+
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        if group is not None:
+            os.chown(path, -1, group)
+        os.chmod(path, mode)
+
+
+class CoordinatorClient(object):
+    def __init__(self, path, client, timeout=2.0):
+        self.path = path
+        self.client = client
+        self.timeout = timeout
+
+    def request(self, op, **kwargs):
+        kwargs["op"] = op
+        kwargs["client"] = self.client
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+            sock.sendall((json.dumps(kwargs) + "\n").encode("utf-8"))
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        except (socket.error, socket.timeout) as e:
+            raise CoordinatorError("%s: %s" % (self.path, e))
+        finally:
+            sock.close()
+
+        try:
+            response = json.loads(data.decode("utf-8"))
+        except ValueError:
+            raise CoordinatorError("Invalid response from %s" % self.path)
+
+        if "error" in response:
+            raise CoordinatorError(response["error"])
+        return response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PSU Control Plus shared power coordinator")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket path (default: %(default)s)")
+    parser.add_argument("--socket-mode", type=lambda value: int(value, 8), default=DEFAULT_SOCKET_MODE,
+                        help="Octal permissions of the socket (default: %o)" % DEFAULT_SOCKET_MODE)
+    parser.add_argument("--socket-group",
+                        help="Group owning the socket, every OctoPrint user sharing the PSU must be in it")
+    parser.add_argument("--power-on-concurrency", type=int, default=1,
+                        help="Instances allowed in their power-on sequence at once (default: %(default)s)")
+    parser.add_argument("--power-on-spacing", type=float, default=2.0,
+                        help="Minimum seconds between PSU switch-ons (default: %(default)s)")
+    parser.add_argument("--power-on-timeout", type=float, default=60.0,
+                        help="Seconds before an unfinished power-on slot is reclaimed (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+    group = None
+    if args.socket_group:
+        try:
+            group = int(args.socket_group)
+        except ValueError:
+            import grp
+            try:
+                group = grp.getgrnam(args.socket_group).gr_gid
+            except KeyError:
+                parser.error("unknown group %s" % args.socket_group)
+
+    admission = AdmissionQueue(args.power_on_concurrency, args.power_on_spacing, args.power_on_timeout)
+    try:
+        server = CoordinatorServer(args.socket, Coordinator(admission), args.socket_mode, group)
+    except CoordinatorError as e:
+        logging.error("%s", e)
+        return 1
+    logging.info("PSU Control Plus coordinator listening on %s", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# One-off analysis of a print job's G-code file.
+#
+# The queuing hook runs for every line of a streamed file. Scanning the file
+# once when it is uploaded or selected tells the plugin whether the job
+# contains pseudo On/Off commands or Auto-On triggers at all, so lines of a
+# clean job can skip the per-line checks.
+
+import io
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# Same command extraction OctoPrint applies before calling the queuing hook.
+_gcode_regex = re.compile(r"^\s*(?:N\d+\s+)?([GM]\d+|T)", re.IGNORECASE)
+
+# Positions are only kept for the first few hits of each kind.
+MAX_POSITIONS = 100
+
+
+def gcode_command(line):
+    match = _gcode_regex.match(line)
+    if match is None:
+        return None
+    return match.group(1).upper()
+
+
+def scan_file(path, pseudoOnGCodeCommand, pseudoOffGCodeCommand, triggerGCodeCommands):
+    triggers = set(triggerGCodeCommands)
+    result = dict(lines=0, pseudoOn=[], pseudoOff=[], triggers=0, firstTrigger=None)
+
+    with io.open(path, "r", encoding="utf-8", errors="replace") as f:
+        lineno = 0
+        for lineno, line in enumerate(f, 1):
+            gcode = gcode_command(line)
+            if gcode is None:
+                continue
+
+            if gcode == pseudoOnGCodeCommand:
+                if len(result["pseudoOn"]) < MAX_POSITIONS:
+                    result["pseudoOn"].append(lineno)
+            elif gcode == pseudoOffGCodeCommand:
+                if len(result["pseudoOff"]) < MAX_POSITIONS:
+                    result["pseudoOff"].append(lineno)
+
+            if gcode in triggers:
+                if result["firstTrigger"] is None:
+                    result["firstTrigger"] = lineno
+                result["triggers"] += 1
+        result["lines"] = lineno
+
+    return result
+
+
+def file_key(path, file_hash=None):
+    if file_hash:
+        return file_hash
+    st = os.stat(path)
+    return "%s:%d:%d" % (path, st.st_size, int(st.st_mtime))
+
+
+class GCodeScanCache(object):
+    def __init__(self, size=64):
+        self._mutex = threading.Lock()
+        self._size = size
+        self._results = OrderedDict()
+
+    def get(self, key):
+        with self._mutex:
+            result = self._results.pop(key, None)
+            if result is not None:
+                self._results[key] = result
+            return result
+
+    def put(self, key, result):
+        with self._mutex:
+            self._results.pop(key, None)
+            self._results[key] = result
+            while len(self._results) > self._size:
+                self._results.popitem(last=False)
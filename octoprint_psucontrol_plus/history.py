@@ -0,0 +1,181 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Bounded in-process history of channel states and power draw.
+#
+# Raw samples (timestamp, channel bitmask, watts) go into a preallocated ring
+# buffer. Every sample also integrates the time since the previous one into
+# fixed-size tiers of per-minute and per-hour buckets, so summaries over any
+# window add up a few hundred buckets instead of scanning raw samples.
+# All storage is allocated up front as `array` buffers (about 0.7 MB with the
+# default sizes). NumPy is used for the aggregations when it is installed.
+
+import threading
+import time
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CHANNELS = ("PSU", "Light", "Fan")
+
+EVENT_IDLE_POWEROFF = 0
+
+
+def channel_mask(states):
+    mask = 0
+    for bit, channel in enumerate(CHANNELS):
+        if states.get(channel):
+            mask |= 1 << bit
+    return mask
+
+
+class _Tier(object):
+    def __init__(self, resolution, size):
+        self.resolution = resolution
+        self.size = size
+        self.start = array("d", [-1.0]) * size
+        self.on = [array("f", [0.0]) * size for _ in CHANNELS]
+        self.energy = array("d", [0.0]) * size
+        self.idlePowerOffs = array("H", [0]) * size
+
+    @property
+    def retention(self):
+        return self.resolution * self.size
+
+    def _slot(self, ts):
+        bucket = int(ts // self.resolution)
+        i = bucket % self.size
+        start = float(bucket * self.resolution)
+        if self.start[i] != start:
+            self.start[i] = start
+            for on in self.on:
+                on[i] = 0.0
+            self.energy[i] = 0.0
+            self.idlePowerOffs[i] = 0
+        return i
+
+    def add(self, ts, end, mask, watts):
+        while ts < end:
+            i = self._slot(ts)
+            chunk = min(end, self.start[i] + self.resolution) - ts
+            for bit, on in enumerate(self.on):
+                if mask & (1 << bit):
+                    on[i] += chunk
+            self.energy[i] += chunk * watts
+            ts += chunk
+
+    def event(self, ts, kind):
+        i = self._slot(ts)
+        if kind == EVENT_IDLE_POWEROFF:
+            self.idlePowerOffs[i] = min(self.idlePowerOffs[i] + 1, 0xffff)
+
+    def _selection(self, start, end):
+        lo = start - start % self.resolution
+        if numpy is not None:
+            starts = numpy.frombuffer(self.start, dtype=numpy.float64)
+            return numpy.nonzero((starts >= lo) & (starts < end))[0]
+        return [i for i in range(self.size) if lo <= self.start[i] < end]
+
+    def _sum(self, values, selection, dtype):
+        if numpy is not None:
+            return float(numpy.frombuffer(values, dtype=dtype)[selection].sum())
+        return float(sum(values[i] for i in selection))
+
+    def summary(self, start, end):
+        selection = self._selection(start, end)
+        return dict(
+            on=[self._sum(on, selection, numpy.float32 if numpy else None) for on in self.on],
+            energy=self._sum(self.energy, selection, numpy.float64 if numpy else None),
+            idlePowerOffs=int(self._sum(self.idlePowerOffs, selection, numpy.uint16 if numpy else None)))
+
+    def series(self, start, end):
+        selection = sorted(self._selection(start, end), key=lambda i: self.start[i])
+        return [dict(start=self.start[i],
+                     on=dict((channel, self.on[bit][i]) for bit, channel in enumerate(CHANNELS)),
+                     energyWh=self.energy[i] / 3600.0,
+                     idlePowerOffs=self.idlePowerOffs[i])
+                for i in selection]
+
+
+class HistoryStore(object):
+    def __init__(self, raw_size=4096, tiers=((60, 7 * 24 * 60), (3600, 366 * 24))):
+        self._mutex = threading.Lock()
+        self._rawSize = raw_size
+        self._rawTime = array("d", [0.0]) * raw_size
+        self._rawMask = array("B", [0]) * raw_size
+        self._rawWatts = array("f", [0.0]) * raw_size
+        self._rawIndex = 0
+        self._rawCount = 0
+        self._tiers = [_Tier(resolution, size) for resolution, size in tiers]
+        self._last = None
+
+    def record(self, mask, watts=None, ts=None):
+        if ts is None:
+            ts = time.time()
+
+        with self._mutex:
+            if self._last is not None:
+                last_ts, last_mask, last_watts = self._last
+                if ts > last_ts:
+                    for tier in self._tiers:
+                        tier.add(last_ts, ts, last_mask, last_watts)
+            self._last = (ts, mask, watts or 0.0)
+
+            i = self._rawIndex
+            self._rawTime[i] = ts
+            self._rawMask[i] = mask
+            self._rawWatts[i] = float("nan") if watts is None else watts
+            self._rawIndex = (i + 1) % self._rawSize
+            self._rawCount = min(self._rawCount + 1, self._rawSize)
+
+    def event(self, kind, ts=None):
+        if ts is None:
+            ts = time.time()
+
+        with self._mutex:
+            for tier in self._tiers:
+                tier.event(ts, kind)
+
+    def _tier_for(self, start, now):
+        for tier in self._tiers:
+            if now - tier.retention <= start:
+                return tier
+        return self._tiers[-1]
+
+    def summary(self, start, end=None, series=False):
+        now = time.time()
+        if end is None:
+            end = now
+
+        with self._mutex:
+            tier = self._tier_for(start, now)
+            s = tier.summary(start, end)
+            points = tier.series(start, end) if series else None
+
+        window = max(end - start, 1e-9)
+        result = dict(
+            start=start,
+            end=end,
+            resolution=tier.resolution,
+            channels=dict((channel, dict(onHours=s["on"][bit] / 3600.0,
+                                         dutyCycle=min(1.0, s["on"][bit] / window)))
+                          for bit, channel in enumerate(CHANNELS)),
+            energyWh=s["energy"] / 3600.0,
+            idlePowerOffs=s["idlePowerOffs"])
+        if series:
+            result["series"] = points
+        return result
+
+    def samples(self, count=None):
+        with self._mutex:
+            n = self._rawCount if count is None else min(count, self._rawCount)
+            first = (self._rawIndex - n) % self._rawSize
+            out = []
+            for k in range(n):
+                i = (first + k) % self._rawSize
+                watts = self._rawWatts[i]
+                out.append((self._rawTime[i], self._rawMask[i], None if watts != watts else watts))
+            return out
@@ -0,0 +1,117 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Idle decisions shared by the plugin and the offline simulator (idlesim), so
+# a replayed log is judged exactly like live traffic.
+#
+# Per-channel idle power-off deadlines are kept in one DeadlineScheduler. Its
+# single thread sleeps until the earliest deadline, so the cost of waiting
+# does not grow with the number of channels or pending timers.
+
+import heapq
+import itertools
+import threading
+import time
+from collections import namedtuple
+
+# timeout and afterDelay in seconds. A channel with `after` set is switched
+# off afterDelay seconds after that channel was switched off when idle,
+# instead of on its own timeout.
+IdlePolicy = namedtuple("IdlePolicy", ["enabled", "timeout", "waitTemp", "heatersOff", "after", "afterDelay"])
+
+
+def resets_idle_timer(gcode, idleIgnoreCommands):
+    return gcode not in idleIgnoreCommands
+
+
+def triggers_auto_on(gcode, autoOnTriggerGCodeCommands):
+    return gcode in autoOnTriggerGCodeCommands
+
+
+def tool_temperatures(heaters):
+    # heaters as returned by printer.get_current_temperatures()
+    temps = dict()
+    for heater, entry in heaters.items():
+        if not heater.startswith("tool"):
+            continue
+
+        actual = entry.get("actual")
+        if actual is None:
+            # heater doesn't exist in fw
+            continue
+
+        try:
+            temps[heater] = float(actual)
+        except ValueError:
+            # not a float for some reason, skip it
+            continue
+    return temps
+
+
+def parsed_tool_temperatures(parsed_temperatures):
+    # parsed_temperatures as passed to the temperatures.received hook, e.g. {"T0": (actual, target)}
+    temps = dict()
+    for key, value in parsed_temperatures.items():
+        if key.startswith("T") and key[1:].isdigit() and value and value[0] is not None:
+            temps["tool" + key[1:]] = value[0]
+    return temps
+
+
+def heaters_cooled(temps, idleTimeoutWaitTemp):
+    return max(list(temps.values()) + [0]) <= idleTimeoutWaitTemp
+
+
+class DeadlineScheduler(object):
+    def __init__(self, logger=None):
+        self._logger = logger
+        self._cond = threading.Condition()
+        self._heap = []
+        self._entries = dict()
+        self._seq = itertools.count()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def schedule(self, key, deadline, callback, *args):
+        # Replaces any pending deadline for key. Stale heap entries are skipped when they surface.
+        with self._cond:
+            seq = next(self._seq)
+            self._entries[key] = (seq, deadline)
+            heapq.heappush(self._heap, (deadline, seq, key, callback, args))
+            self._cond.notify()
+
+    def cancel(self, key):
+        with self._cond:
+            self._entries.pop(key, None)
+
+    def deadline(self, key):
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and self._entries.get(self._heap[0][2], (None,))[0] != self._heap[0][1]:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+
+                    delay = self._heap[0][0] - time.time()
+                    if delay <= 0:
+                        deadline, seq, key, callback, args = heapq.heappop(self._heap)
+                        del self._entries[key]
+                        break
+                    self._cond.wait(delay)
+
+            try:
+                callback(*args)
+            except Exception:
+                if self._logger is not None:
+                    self._logger.exception("Error in idle deadline for %s" % key)
@@ -0,0 +1,243 @@
+# coding=utf-8
+from __future__ import absolute_import, print_function
+
+# Offline idle-policy simulator.
+#
+# Replays an OctoPrint serial.log (or a timeline of "<epoch seconds> <line>"
+# entries) through the same command matching and heater checks as the
+# plugin's queuing hook and idle power-off, for every combination of the
+# given idle timeouts, wait temperatures and ignore lists in a single pass.
+# Logs are streamed line by line, so memory does not grow with their size.
+#
+#   python -m octoprint_psucontrol_plus.idlesim serial.log --timeout 10,30,60 --wait-temp 40,50
+#
+# The PSU is assumed to come back on at the next Auto-On trigger command,
+# and every such cold start is charged --warmup seconds.
+
+import argparse
+import calendar
+import gzip
+import io
+import itertools
+import re
+
+from .gcodescan import gcode_command
+from .idlepolicy import resets_idle_timer, triggers_auto_on, heaters_cooled
+
+_serial_log_regex = re.compile(r"^(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d),(\d{3}) - (Send|Recv): (.*)")
+_temp_regex = re.compile(r"(B|C|T(\d*)):\s*([-+]?\d*\.?\d+)")
+
+EVENT_COMMAND = 0
+EVENT_TEMPERATURE = 1
+
+
+def _parse_temperatures(line):
+    temps = dict()
+    current = None
+    for match in _temp_regex.finditer(line):
+        name, toolnum, actual = match.groups()
+        if name == "B" or name == "C":
+            continue
+        if toolnum:
+            temps["tool%s" % toolnum] = float(actual)
+        else:
+            current = float(actual)
+    if not temps and current is not None:
+        temps["tool0"] = current
+    return temps
+
+
+def read_events(f):
+    # Yields (timestamp, EVENT_COMMAND, gcode) and (timestamp, EVENT_TEMPERATURE, tool temperatures).
+    midnights = dict()
+    for line in f:
+        match = _serial_log_regex.match(line)
+        if match is not None:
+            g = match.groups()
+            day = g[0:3]
+            midnight = midnights.get(day)
+            if midnight is None:
+                midnight = midnights[day] = calendar.timegm((int(g[0]), int(g[1]), int(g[2]), 0, 0, 0))
+            t = midnight + int(g[3]) * 3600 + int(g[4]) * 60 + int(g[5]) + int(g[6]) / 1000.0
+            direction, text = g[7], g[8]
+        else:
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                continue
+            try:
+                t = float(parts[0])
+            except ValueError:
+                continue
+            text = parts[1]
+            direction = None
+            if text.startswith("Send:") or text.startswith("Recv:"):
+                direction, text = text[:4], text[5:]
+
+        if direction != "Send" and "T" in text and ":" in text:
+            temps = _parse_temperatures(text)
+            if temps:
+                yield t, EVENT_TEMPERATURE, temps
+                continue
+
+        if direction != "Recv":
+            gcode = gcode_command(text)
+            if gcode is not None:
+                yield t, EVENT_COMMAND, gcode
+
+
+class _Policy(object):
+    __slots__ = ("timeout", "waitTemp", "ignore", "waitIndex", "ignoreIndex",
+                 "on", "wokeAt", "offAt", "offSeconds", "powerOffs")
+
+    def __init__(self, timeout, waitTemp, ignore, waitIndex, ignoreIndex):
+        self.timeout = timeout
+        self.waitTemp = waitTemp
+        self.ignore = ignore
+        self.waitIndex = waitIndex
+        self.ignoreIndex = ignoreIndex
+        self.on = True
+        self.wokeAt = None
+        self.offAt = None
+        self.offSeconds = 0.0
+        self.powerOffs = 0
+
+
+class IdleSimulator(object):
+    def __init__(self, idleTimeouts, idleTimeoutWaitTemps, idleIgnoreCommandLists, autoOnTriggerGCodeCommands):
+        self.waitTemps = list(idleTimeoutWaitTemps)
+        self.ignoreLists = [list(ignore) for ignore in idleIgnoreCommandLists]
+        self.triggers = list(autoOnTriggerGCodeCommands)
+        self.policies = [_Policy(timeout * 60.0, self.waitTemps[w], self.ignoreLists[i], w, i)
+                         for timeout, w, i in itertools.product(idleTimeouts,
+                                                                range(len(self.waitTemps)),
+                                                                range(len(self.ignoreLists)))]
+        self._minTimeout = min(p.timeout for p in self.policies)
+        self._lastActivity = [None] * len(self.ignoreLists)
+        self._coolSince = [None] * len(self.waitTemps)
+        self._offCount = 0
+        self.start = None
+        self.end = None
+
+    def _evaluate(self, t):
+        for p in self.policies:
+            if not p.on:
+                continue
+            due = max(self._lastActivity[p.ignoreIndex], p.wokeAt) + p.timeout
+            coolSince = self._coolSince[p.waitIndex]
+            if due > t or coolSince is None:
+                continue
+            off = max(due, coolSince)
+            if off <= t:
+                p.on = False
+                p.offAt = off
+                p.powerOffs += 1
+                self._offCount += 1
+
+    def feed(self, t, kind, value):
+        if self.start is None:
+            self.start = t
+            # No temperature reported yet reads as cold, like a disconnected printer.
+            self._coolSince = [t] * len(self.waitTemps)
+            self._lastActivity = [t] * len(self.ignoreLists)
+            for p in self.policies:
+                p.wokeAt = t
+        self.end = t
+
+        if kind == EVENT_TEMPERATURE:
+            cooledNow = False
+            for w, waitTemp in enumerate(self.waitTemps):
+                if heaters_cooled(value, waitTemp):
+                    if self._coolSince[w] is None:
+                        self._coolSince[w] = t
+                        cooledNow = True
+                else:
+                    self._coolSince[w] = None
+            if cooledNow:
+                self._evaluate(t)
+            return
+
+        gcode = value
+        if any(t - last >= self._minTimeout for last in self._lastActivity):
+            self._evaluate(t)
+
+        if self._offCount and (triggers_auto_on(gcode, self.triggers) or not self.triggers):
+            for p in self.policies:
+                if not p.on:
+                    p.on = True
+                    p.offSeconds += t - p.offAt
+                    p.wokeAt = t
+            self._offCount = 0
+
+        for i, ignore in enumerate(self.ignoreLists):
+            if resets_idle_timer(gcode, ignore):
+                self._lastActivity[i] = t
+
+    def finish(self):
+        if self.end is None:
+            return
+        self._evaluate(self.end)
+        for p in self.policies:
+            if not p.on:
+                p.offSeconds += self.end - p.offAt
+
+    def results(self, warmup):
+        return sorted((dict(idleTimeout=p.timeout / 60.0,
+                            idleTimeoutWaitTemp=p.waitTemp,
+                            idleIgnoreCommands=",".join(p.ignore),
+                            powerOffs=p.powerOffs,
+                            hoursSaved=p.offSeconds / 3600.0,
+                            warmupMinutes=(p.powerOffs - (0 if p.on else 1)) * warmup / 60.0)
+                       for p in self.policies),
+                      key=lambda r: -r["hoursSaved"])
+
+
+def _open(path):
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8", errors="replace")
+    return io.open(path, "r", encoding="utf-8", errors="replace")
+
+
+def _number_list(value):
+    return [float(v) for v in value.split(",") if v.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay OctoPrint serial logs through PSU Control Plus idle policies")
+    parser.add_argument("logs", nargs="+", help="serial.log files or timelines, optionally gzipped, in time order")
+    parser.add_argument("--timeout", type=_number_list, default=[30.0],
+                        help="Comma separated idle timeouts in minutes (default: 30)")
+    parser.add_argument("--wait-temp", type=_number_list, default=[50.0],
+                        help="Comma separated wait temperatures in degrees C (default: 50)")
+    parser.add_argument("--ignore", action="append",
+                        help="Comma separated idle ignore commands, repeat to compare lists (default: M105)")
+    parser.add_argument("--triggers", default="G0,G1,G2,G3,G10,G11,G28,G29,G32,M104,M106,M109,M140,M190",
+                        help="Comma separated Auto-On trigger commands")
+    parser.add_argument("--warmup", type=float, default=120.0,
+                        help="Seconds charged for every cold start (default: %(default)s)")
+    parser.add_argument("--top", type=int, default=20, help="Number of results to print (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    ignoreLists = [ignore.split(',') for ignore in (args.ignore or ["M105"])]
+    triggers = [trigger for trigger in args.triggers.split(',') if trigger]
+    simulator = IdleSimulator(args.timeout, args.wait_temp, ignoreLists, triggers)
+
+    for path in args.logs:
+        with _open(path) as f:
+            for t, kind, value in read_events(f):
+                simulator.feed(t, kind, value)
+    simulator.finish()
+
+    if simulator.start is None:
+        print("No events found.")
+        return
+
+    print("Replayed %.1f hours of log." % ((simulator.end - simulator.start) / 3600.0))
+    print("%8s %9s %-20s %9s %10s %10s" % ("timeout", "waitTemp", "ignore", "powerOffs", "hoursSaved", "warmupMin"))
+    for r in simulator.results(args.warmup)[:args.top]:
+        print("%8.1f %9.1f %-20s %9d %10.2f %10.1f" % (r["idleTimeout"], r["idleTimeoutWaitTemp"],
+                                                       r["idleIgnoreCommands"], r["powerOffs"],
+                                                       r["hoursSaved"], r["warmupMinutes"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Structured journal of switching, sensing and idle events.
+#
+# Emitters append fixed-layout (timestamp, kind, channel, value) tuples to a
+# bounded deque, which needs no lock in CPython. A background writer drains it
+# once per flush interval and appends the batch to a JSONL file, rotating it
+# by size, so emitting from the queuing hook or the sensing loop never waits
+# on disk I/O.
+
+import io
+import json
+import os
+import threading
+import time
+from collections import deque
+
+SWITCH = "switch"
+STATE = "state"
+AUTO_ON = "autoOn"
+IDLE_WAIT = "idleWait"
+IDLE_ABORT = "idleAbort"
+IDLE_POWEROFF = "idlePowerOff"
+DUTY = "duty"
+PRE_ARM = "preArm"
+PRE_ARM_CANCEL = "preArmCancel"
+
+_FIELDS = ("time", "kind", "channel", "value")
+
+
+class EventJournal(object):
+    # Write failures are logged at most this often, with the number of events lost since.
+    error_log_interval = 300.0
+
+    def __init__(self, path, max_bytes=1024 * 1024, backups=3, flush_interval=1.0, max_pending=10000, logger=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self._queue = deque(maxlen=max_pending)
+        self._logger = logger
+        self._lost = 0
+        self._lastError = None
+        self._stop = threading.Event()
+        self._fileMutex = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, kind, channel=None, value=None):
+        self._queue.append((time.time(), kind, channel, value))
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(self.flush_interval * 2)
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        if not self._queue:
+            return
+
+        with self._fileMutex:
+            lines = []
+            while True:
+                try:
+                    event = self._queue.popleft()
+                except IndexError:
+                    break
+                lines.append(json.dumps(dict(zip(_FIELDS, event))) + "\n")
+
+            try:
+                self._rotate()
+                with io.open(self.path, "a", encoding="utf-8") as f:
+                    f.write(u"".join(lines))
+            except (IOError, OSError) as e:
+                self._lost += len(lines)
+                now = time.time()
+                if self._lastError is None or now - self._lastError >= self.error_log_interval:
+                    self._lastError = now
+                    if self._logger is not None:
+                        self._logger.warning("Could not write %d journal event(s) to %s: %s" % (self._lost, self.path, e))
+                    self._lost = 0
+
+    def _rotate(self):
+        try:
+            if os.path.getsize(self.path) < self.max_bytes:
+                return
+        except OSError:
+            return
+
+        for i in range(self.backups - 1, 0, -1):
+            src = "%s.%d" % (self.path, i)
+            if os.path.exists(src):
+                os.rename(src, "%s.%d" % (self.path, i + 1))
+        os.rename(self.path, "%s.1" % self.path)
+
+    def query(self, since=None, until=None, kinds=None, channel=None, limit=None):
+        self.flush()
+
+        paths = ["%s.%d" % (self.path, i) for i in range(self.backups, 0, -1)] + [self.path]
+        events = deque(maxlen=limit) if limit else []
+        with self._fileMutex:
+            for path in paths:
+                if not os.path.exists(path):
+                    continue
+                with io.open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            event = json.loads(line)
+                        except ValueError:
+                            continue
+                        if since is not None and event["time"] < since:
+                            continue
+                        if until is not None and event["time"] > until:
+                            continue
+                        if kinds and event["kind"] not in kinds:
+                            continue
+                        if channel is not None and event["channel"] != channel:
+                            continue
+                        events.append(event)
+        return list(events)
@@ -0,0 +1,131 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# PWM output for the Fan channel and the ramp profiles that drive it.
+#
+# When the pigpio daemon is running, pins wired to the PWM peripheral (BCM 12,
+# 13, 18 and 19) use hardware PWM and other pins use pigpio's DMA-timed PWM,
+# so neither keeps a thread toggling the pin. Without pigpio, RPi.GPIO's
+# software PWM is used.
+
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+
+HARDWARE_PWM_PINS = (12, 13, 18, 19)
+
+
+class _PigpioPWM(object):
+    def __init__(self, bcm, frequency):
+        self._pi = pigpio.pi()
+        if not self._pi.connected:
+            raise OSError("pigpio daemon is not running")
+        self._bcm = bcm
+        self._frequency = frequency
+        if bcm in HARDWARE_PWM_PINS:
+            self.backend = "hardware"
+        else:
+            self.backend = "pigpio"
+            self._pi.set_PWM_frequency(bcm, frequency)
+            self._pi.set_PWM_range(bcm, 1000)
+
+    def set_duty(self, duty):
+        if self.backend == "hardware":
+            self._pi.hardware_PWM(self._bcm, self._frequency, int(round(duty * 10000)))
+        else:
+            self._pi.set_PWM_dutycycle(self._bcm, int(round(duty * 10)))
+
+    def close(self):
+        self._pi.stop()
+
+
+class _GPIOPWM(object):
+    backend = "software"
+
+    def __init__(self, gpio, pin, frequency, duty=0):
+        self._pwm = gpio.PWM(pin, frequency)
+        self._pwm.start(duty)
+
+    def set_duty(self, duty):
+        self._pwm.ChangeDutyCycle(duty)
+
+    def close(self):
+        self._pwm.stop()
+
+
+class PWMOutput(object):
+    def __init__(self, gpio, pin, bcm=None, frequency=1000, invert=False, hardware=True, logger=None, duty=0):
+        # pin in RPi.GPIO numbering, bcm the same pin in BCM numbering for pigpio, duty the initial duty
+        self.invert = invert
+        self.duty = 0.0
+        self._output = None
+
+        if pigpio is not None and hardware and bcm is not None:
+            try:
+                self._output = _PigpioPWM(bcm, frequency)
+            except (OSError, pigpio.error) as e:
+                if logger is not None:
+                    logger.warning("pigpio PWM on GPIO%s failed, using software PWM: %s" % (bcm, e))
+                self._output = None
+
+        duty = min(100.0, max(0.0, float(duty)))
+        if self._output is None:
+            self._output = _GPIOPWM(gpio, pin, frequency, 100.0 - duty if invert else duty)
+        self.set_duty(duty)
+
+    @property
+    def backend(self):
+        return self._output.backend
+
+    def set_duty(self, duty):
+        self.duty = min(100.0, max(0.0, float(duty)))
+        self._output.set_duty(100.0 - self.duty if self.invert else self.duty)
+
+    def close(self, zero=True):
+        if zero:
+            self.set_duty(0)
+        self._output.close()
+
+
+class RampProfile(object):
+    # Piecewise linear duty profile from "x:duty" points, e.g. "0:100,300:40,900:20".
+    # x is seconds for time ramps and degrees C for temperature ramps. The duty
+    # is held at the first and last point outside their range.
+
+    def __init__(self, points):
+        if not points:
+            raise ValueError("A ramp profile needs at least one point")
+        self.points = sorted((float(x), min(100.0, max(0.0, float(duty)))) for x, duty in points)
+
+    @classmethod
+    def parse(cls, text):
+        points = []
+        for entry in text.split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+            x, sep, duty = entry.partition(":")
+            if not sep:
+                raise ValueError("Ramp point %r is not x:duty" % entry)
+            points.append((float(x), float(duty)))
+        return cls(points)
+
+    def duty_at(self, x):
+        points = self.points
+        if x <= points[0][0]:
+            return points[0][1]
+        for (x0, d0), (x1, d1) in zip(points, points[1:]):
+            if x <= x1:
+                return d0 + (d1 - d0) * (x - x0) / (x1 - x0)
+        return points[-1][1]
+
+    def next_change(self, x, resolution=1.0):
+        # Next x at which the duty has moved by about `resolution` percent, None once it stays constant.
+        for (x0, d0), (x1, d1) in zip([(float("-inf"), self.points[0][1])] + self.points, self.points):
+            if x >= x1:
+                continue
+            if d0 == d1:
+                return x1
+            return min(x1, max(x, x0) + (x1 - x0) * resolution / abs(d1 - d0))
+        return None
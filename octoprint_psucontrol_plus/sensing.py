@@ -0,0 +1,159 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Batched reading of the PSU, Light and Fan sense pins.
+#
+# With libgpiod's Python bindings installed all sense lines are requested
+# together and read with a single get_values() call. Without them the pins
+# are read back to back through RPi.GPIO. Either way a poll yields one
+# timestamped snapshot of every channel.
+#
+# Noisy inputs can be passed through a SenseFilter before they reach the
+# plugin state, so a marginal relay does not restart the idle timer and
+# broadcast a new state on every poll.
+
+import time
+from collections import namedtuple
+
+try:
+    import gpiod
+except ImportError:
+    gpiod = None
+
+SenseSnapshot = namedtuple("SenseSnapshot", ["timestamp", "values", "duration"])
+
+_CONSUMER = "psucontrol_plus"
+
+
+class _GpiodV1Lines(object):
+    def __init__(self, chip, offsets):
+        self._chip = gpiod.Chip(chip)
+        self._lines = self._chip.get_lines(offsets)
+        self._lines.request(consumer=_CONSUMER, type=gpiod.LINE_REQ_DIR_IN)
+
+    def get_values(self):
+        return self._lines.get_values()
+
+    def release(self):
+        self._lines.release()
+        self._chip.close()
+
+
+class _GpiodV2Lines(object):
+    def __init__(self, chip, offsets):
+        path = chip if chip.startswith("/") else "/dev/" + chip
+        self._offsets = offsets
+        self._request = gpiod.request_lines(
+            path, consumer=_CONSUMER,
+            config={tuple(offsets): gpiod.LineSettings(direction=gpiod.line.Direction.INPUT)})
+
+    def get_values(self):
+        return [1 if v == gpiod.line.Value.ACTIVE else 0 for v in self._request.get_values(self._offsets)]
+
+    def release(self):
+        self._request.release()
+
+
+class GPIOSenseReader(object):
+    def __init__(self, gpio, pins, offsets=None, chip=None, logger=None):
+        # pins: channel -> pin in RPi.GPIO numbering, offsets: channel -> BCM line offset
+        self._gpio = gpio
+        self._channels = list(pins.keys())
+        self._pins = [pins[c] for c in self._channels]
+        self._lines = None
+
+        if gpiod is not None and chip and offsets:
+            try:
+                lines_class = _GpiodV2Lines if hasattr(gpiod, "request_lines") else _GpiodV1Lines
+                self._lines = lines_class(chip, [offsets[c] for c in self._channels])
+            except (OSError, ValueError, TypeError) as e:
+                if logger is not None:
+                    logger.warning("libgpiod request on %s failed, reading pins one by one: %s" % (chip, e))
+                self._lines = None
+
+    @property
+    def batched(self):
+        return self._lines is not None
+
+    def read(self):
+        start = time.time()
+        if self._lines is not None:
+            raw = self._lines.get_values()
+        else:
+            raw = [self._gpio.input(pin) for pin in self._pins]
+        return SenseSnapshot(start, dict(zip(self._channels, raw)), time.time() - start)
+
+    def close(self):
+        if self._lines is not None:
+            self._lines.release()
+            self._lines = None
+
+
+class SenseFilter(object):
+    # Debounces one sense input. The last `window` raw readings are kept in a
+    # ring buffer and the filtered state only flips when the opposite reading
+    # wins the vote by `hysteresis` extra samples and the current state has
+    # been held for at least `dwell` seconds.
+
+    def __init__(self, window=5, hysteresis=1, dwell=0.0):
+        self.window = max(1, window)
+        self.hysteresis = max(0, hysteresis)
+        self.dwell = max(0.0, dwell)
+        self._buffer = [False] * self.window
+        self._index = 0
+        self._count = 0
+        self._ones = 0
+        self._lastRaw = None
+        self._changed = 0
+        self.state = None
+        self.rawTransitions = 0
+        self.transitions = 0
+
+    def update(self, value, now=None):
+        value = bool(value)
+        if now is None:
+            now = time.time()
+
+        if self._lastRaw is not None and value != self._lastRaw:
+            self.rawTransitions += 1
+        self._lastRaw = value
+
+        if self._count == self.window:
+            self._ones -= self._buffer[self._index]
+        else:
+            self._count += 1
+        self._buffer[self._index] = value
+        self._ones += value
+        self._index = (self._index + 1) % self.window
+
+        if self.state is None:
+            self.state = value
+            self._changed = now
+            return self.state
+
+        votes = self._count - self._ones if self.state else self._ones
+        needed = min(self.window, self.window // 2 + 1 + self.hysteresis)
+        if votes >= needed and now - self._changed >= self.dwell:
+            self.state = not self.state
+            self._changed = now
+            self.transitions += 1
+
+        return self.state
+
+    def reset(self, value, now=None):
+        # Seeds the window with a commanded state, so the readings taken just
+        # after the plugin switched the channel don't vote it back.
+        value = bool(value)
+        self._buffer = [value] * self.window
+        self._index = 0
+        self._count = self.window
+        self._ones = self.window if value else 0
+        self._lastRaw = value
+        self.state = value
+        self._changed = time.time() if now is None else now
+
+    def stats(self):
+        return dict(state=self.state,
+                    rawTransitions=self.rawTransitions,
+                    transitions=self.transitions,
+                    suppressed=max(0, self.rawTransitions - self.transitions))
@@ -0,0 +1,40 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# Pre-serialized responses for the polled state endpoint.
+#
+# The caller builds the small payload dict on every request, but it is only
+# serialized when it differs from the previous one, which also bumps the
+# version. ETags carry the process start time, so a client's tag from before
+# a restart can't match a different state with the same version.
+
+import json
+import threading
+import time
+
+
+class StateCache(object):
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._epoch = "%x" % int(time.time())
+        self._payload = None
+        self.version = 0
+        self.etag = None
+        self.body = None
+
+    def get(self, payload):
+        # Returns (version, etag, body) for payload.
+        with self._mutex:
+            if self.body is None or payload != self._payload:
+                self._payload = payload
+                self.version += 1
+                self.etag = '"%s-%d"' % (self._epoch, self.version)
+                self.body = json.dumps(dict(payload, version=self.version), separators=(",", ":"), sort_keys=True)
+            return self.version, self.etag, self.body
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or "W/" + etag in tags
@@ -59,7 +59,11 @@ def params():
 	# Hook the plugin into the "octoprint.plugin" entry point, mapping the plugin_identifier to the plugin_package.
 	# That way OctoPrint will be able to find the plugin and load it.
 	entry_points = {
-		"octoprint.plugin": ["%s = %s" % (plugin_identifier, plugin_package)]
+		"octoprint.plugin": ["%s = %s" % (plugin_identifier, plugin_package)],
+		"console_scripts": [
+			"psucontrol-plus-coordinator = %s.coordinator:main" % plugin_package,
+			"psucontrol-plus-idlesim = %s.idlesim:main" % plugin_package
+		]
 	}
 
 	return locals()
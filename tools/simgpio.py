@@ -0,0 +1,113 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+# In-memory stand-in for the parts of RPi.GPIO the plugin uses, for the
+# stress harness and other offline tools. Every output write is appended to
+# a timeline of (timestamp, thread, pin, value) entries and every PWM duty
+# change to a duty timeline of (timestamp, thread, pin, duty) entries. Input
+# pins can be wired to read back the level of an output pin, like a sense
+# line on the switched supply; a PWM pin reads high while its duty is above 0.
+
+import threading
+import time
+
+
+class SimGPIO(object):
+    VERSION = "0.7.0"
+    RPI_REVISION = 3
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    def __init__(self, wiring=None, listener=None):
+        # wiring: input pin -> output pin it reads back
+        # listener: called as listener(pin, value, previous) for every write, while the pin is locked
+        self.wiring = dict(wiring or {})
+        self.listener = listener
+        self.levels = dict()
+        self.modes = dict()
+        self.timeline = []
+        self.dutyTimeline = []
+        self._mode = None
+        self._mutex = threading.Lock()
+
+    def setwarnings(self, flag):
+        pass
+
+    def getmode(self):
+        return self._mode
+
+    def setmode(self, mode):
+        self._mode = mode
+
+    def setup(self, pin, mode, pull_up_down=PUD_OFF, initial=None):
+        # Like RPi.GPIO, an output set up without an initial level keeps its current one.
+        self.modes[pin] = mode
+        if mode == self.OUT and initial is not None:
+            self._write(pin, initial)
+
+    def output(self, pin, value):
+        if self.modes.get(pin) != self.OUT:
+            raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+        self._write(pin, value)
+
+    def input(self, pin):
+        if pin not in self.modes:
+            raise RuntimeError("You must setup() the GPIO channel first")
+        return self.levels.get(self.wiring.get(pin, pin), self.LOW)
+
+    def cleanup(self, pin=None):
+        if pin is None:
+            self.modes.clear()
+        else:
+            self.modes.pop(pin, None)
+
+    def PWM(self, pin, frequency):
+        if self.modes.get(pin) != self.OUT:
+            raise RuntimeError("You must setup() the GPIO channel as an output first")
+        return _SimPWM(self, pin, frequency)
+
+    def _set_duty(self, pin, duty):
+        with self._mutex:
+            self.levels[pin] = self.HIGH if duty > 0 else self.LOW
+            self.dutyTimeline.append((time.time(), threading.current_thread().name, pin, duty))
+
+    def _write(self, pin, value):
+        value = self.HIGH if value else self.LOW
+        with self._mutex:
+            previous = self.levels.get(pin, self.LOW)
+            self.levels[pin] = value
+            self.timeline.append((time.time(), threading.current_thread().name, pin, value))
+            if self.listener is not None:
+                self.listener(pin, value, previous)
+
+
+class _SimPWM(object):
+    def __init__(self, gpio, pin, frequency):
+        self._gpio = gpio
+        self.pin = pin
+        self.frequency = frequency
+        self.running = False
+
+    def start(self, duty):
+        self.running = True
+        self._gpio._set_duty(self.pin, duty)
+
+    def ChangeDutyCycle(self, duty):
+        if self.running:
+            self._gpio._set_duty(self.pin, duty)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self._gpio._set_duty(self.pin, 0)
@@ -0,0 +1,436 @@
+# coding=utf-8
+from __future__ import absolute_import, print_function
+
+# Concurrency stress harness for switching and sensing.
+#
+# Runs the plugin against SimGPIO, with every switched output wired back to
+# its sense pin, and a fake printer. Worker threads drive the API turn and
+# toggle commands, Auto-On from the queuing hook, idle power-off and sensing
+# passes while the plugin's own sensing loop and idle scheduler keep running.
+# Every side effect is recorded in one ordered trace, tagged with the
+# operation that caused it, and the trace is checked for:
+#
+#   overlap   side effects of two switch operations interleaved
+#   doubleOn  Auto-On switching on a PSU that already was on
+#   stale     a toggle, idle power-off or post-on script acting on stale state
+#   lostState plugin state at the end differing from the pins or connection
+#
+# The operation mix of each thread is derived from --seed, so a failing run
+# can be repeated. Plugin sleeps are scaled by --time-scale. The mix runs
+# once with raw sensing and once through the sense filter, unless
+# --sense-filter picks one of them.
+#
+#   python tools/stress.py --threads 8 --ops 200 --seed 1
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import octoprint_psucontrol_plus as package
+from simgpio import SimGPIO
+
+OPERATIONS = ("turnPSUOn", "turnPSUOff", "togglePSU", "autoOn", "idlePowerOff", "sense",
+              "turnLightOn", "turnLightOff", "toggleLight", "toggleFan")
+
+OUTPUT_PINS = dict(PSU=17, Light=22, Fan=24)
+SENSE_PINS = dict(PSU=27, Light=23, Fan=25)
+
+# Sense settings of each configuration, the filtered one uses the plugin's default filter.
+SENSE_CONFIGURATIONS = (("raw", dict(senseFilterEnabled=False)),
+                        ("filtered", dict(senseFilterEnabled=True)))
+
+
+class Trace(object):
+    def __init__(self):
+        self.events = []
+        self._mutex = threading.Lock()
+        self._local = threading.local()
+        self._opIds = itertools.count(1)
+
+    def current(self):
+        return getattr(self._local, "op", None)
+
+    @contextmanager
+    def operation(self, name):
+        self._local.op = (next(self._opIds), name)
+        try:
+            yield
+        finally:
+            self._local.op = None
+
+    def record(self, kind, **detail):
+        op = self.current()
+        with self._mutex:
+            self.events.append(dict(seq=len(self.events), time=time.time(),
+                                    thread=threading.current_thread().name,
+                                    opId=op[0] if op else None, op=op[1] if op else None,
+                                    kind=kind, detail=detail))
+
+
+class _Settings(object):
+    def __init__(self, values):
+        self._values = values
+
+    def get(self, path):
+        return self._values.get(path[0])
+
+    def get_int(self, path):
+        value = self._values.get(path[0])
+        return None if value is None else int(value)
+
+    def get_float(self, path):
+        value = self._values.get(path[0])
+        return None if value is None else float(value)
+
+    def get_boolean(self, path):
+        value = self._values.get(path[0])
+        return None if value is None else bool(value)
+
+    def set(self, path, value):
+        self._values[path[0]] = value
+
+    set_boolean = set
+
+    def save(self):
+        pass
+
+    def listScripts(self, script_type):
+        return ["psucontrol_post_on", "psucontrol_pre_off"]
+
+    def saveScript(self, script_type, name, script):
+        pass
+
+
+class _Printer(object):
+    def __init__(self, trace, gpio):
+        self._trace = trace
+        self._gpio = gpio
+        self._closed = True
+        self._mutex = threading.Lock()
+
+    def _psu_level(self):
+        return self._gpio.levels.get(OUTPUT_PINS["PSU"], SimGPIO.LOW)
+
+    def is_printing(self):
+        return False
+
+    def is_paused(self):
+        return False
+
+    def get_current_temperatures(self):
+        return {"tool0": {"actual": 25.0, "target": 0.0}}
+
+    def set_temperature(self, heater, value):
+        self._trace.record("setTemperature", heater=heater, value=value)
+
+    def commands(self, commands):
+        self._trace.record("commands", commands=commands)
+
+    def is_closed_or_error(self):
+        return self._closed
+
+    def connect(self):
+        with self._mutex:
+            self._closed = False
+            self._trace.record("connect", psu=self._psu_level())
+
+    def disconnect(self):
+        with self._mutex:
+            self._closed = True
+            self._trace.record("disconnect", psu=self._psu_level())
+
+    def script(self, name, must_be_set=True):
+        with self._mutex:
+            self._trace.record("script", name=name, psu=self._psu_level())
+
+
+class _PluginManager(object):
+    def send_plugin_message(self, identifier, data):
+        pass
+
+
+class _ScaledTime(object):
+    def __init__(self, scale):
+        self.scale = scale
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds * self.scale)
+
+
+class _NoLock(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _traced(trace, name, func):
+    # Entry points the plugin calls on its own threads are tagged like worker operations.
+    def wrapper(*args, **kwargs):
+        if trace.current() is not None:
+            return func(*args, **kwargs)
+        with trace.operation(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def create_plugin(trace, lock=True, logger=None, settings=None):
+    gpio = SimGPIO(wiring=dict((SENSE_PINS[fn], OUTPUT_PINS[fn]) for fn in OUTPUT_PINS),
+                   listener=lambda pin, value, previous: trace.record("output", pin=pin, value=value, previous=previous))
+
+    plugin = package.PSUControlPlus()
+    package.GPIO = gpio
+    plugin._hasGPIO = True
+    if not lock:
+        plugin._switchMutex = _NoLock()
+
+    values = plugin.get_settings_defaults()
+    values.update(
+        GPIOMode='BCM',
+        switchingMethod='GPIO',
+        onoffPSUGPIOPin=OUTPUT_PINS["PSU"],
+        onoffLightGPIOPin=OUTPUT_PINS["Light"],
+        onoffFanGPIOPin=OUTPUT_PINS["Fan"],
+        lightEnabled=True,
+        fanEnabled=True,
+        sensingMethod='GPIO',
+        senseGPIOPin=SENSE_PINS["PSU"],
+        senseLightGPIOPin=SENSE_PINS["Light"],
+        senseFanGPIOPin=SENSE_PINS["Fan"],
+        senseGPIOChip='',
+        senseGPIOPinPUD='',
+        sensePollingInterval=1,
+        postOnDelay=0.0,
+        connectOnPowerOn=True,
+        disconnectOnPowerOff=True,
+        autoOn=True,
+        autoOnTriggerGCodeCommands='G28',
+        powerOffPSUWhenIdle=True,
+        idlePSUTimeout=0,
+        journalEnabled=False,
+        coordinatorEnabled=False)
+    values.update(settings or {})
+
+    dataFolder = tempfile.mkdtemp(prefix="psucontrol_plus_stress")
+    plugin._identifier = "psucontrol_plus"
+    plugin._logger = logger or logging.getLogger("octoprint.plugins.psucontrol_plus.stress")
+    plugin._settings = _Settings(values)
+    plugin._printer = _Printer(trace, gpio)
+    plugin._plugin_manager = _PluginManager()
+    plugin._file_manager = None
+    plugin.get_plugin_data_folder = lambda: dataFolder
+    plugin._idle_poweroff = _traced(trace, "idlePowerOff", plugin._idle_poweroff)
+    plugin.on_settings_initialized()
+    return plugin, gpio, dataFolder
+
+
+def run_operation(plugin, op):
+    if op == "autoOn":
+        plugin.hook_gcode_queuing(None, "queuing", "G28", None, "G28")
+    elif op == "idlePowerOff":
+        plugin._idle_poweroff("PSU")
+    elif op == "sense":
+        plugin._sense_all_state()
+    elif op.startswith("toggle"):
+        plugin._switch(op[6:], "Toggle")
+    else:
+        what = "PSU" if "PSU" in op else "Light" if "Light" in op else "Fan"
+        plugin._switch(what, op[4 + len(what):])
+
+
+def _worker(plugin, trace, ops, latencies, start):
+    start.wait()
+    for op in ops:
+        t = time.time()
+        with trace.operation(op):
+            run_operation(plugin, op)
+        latencies.append((op, time.time() - t))
+
+
+def check_trace(events):
+    violations = []
+    channels = dict((pin, fn) for fn, pin in OUTPUT_PINS.items())
+
+    current = None
+    finished = set()
+    for event in events:
+        opId = event["opId"]
+        if opId is None:
+            continue
+        if opId != current:
+            if opId in finished:
+                violations.append(("overlap", event))
+            if current is not None:
+                finished.add(current)
+            current = opId
+
+        detail = event["detail"]
+        if event["kind"] == "output":
+            fn = channels.get(detail["pin"])
+            repeated = detail["value"] == detail["previous"]
+            if event["op"] == "autoOn" and fn == "PSU" and repeated:
+                violations.append(("doubleOn", event))
+            elif event["op"] == "toggle" + str(fn) and repeated:
+                violations.append(("stale", event))
+            elif event["op"] == "idlePowerOff" and fn == "PSU" and repeated:
+                violations.append(("stale", event))
+        elif event["kind"] == "script" and detail["name"] == "psucontrol_post_on" and not detail["psu"]:
+            violations.append(("stale", event))
+    return violations
+
+
+def check_final_state(plugin, gpio):
+    violations = []
+    with plugin._switchMutex:
+        plugin._sense_all_state()
+        for fn, pin in OUTPUT_PINS.items():
+            level = gpio.levels.get(pin, gpio.LOW) == gpio.HIGH
+            if plugin._isWhatOn(fn, '') != level:
+                violations.append(("lostState", dict(channel=fn, state=plugin._isWhatOn(fn, ''), pin=level)))
+        psu = gpio.levels.get(OUTPUT_PINS["PSU"], gpio.LOW) == gpio.HIGH
+        if plugin._printer.is_closed_or_error() == psu:
+            violations.append(("lostState", dict(channel="connection", connected=not plugin._printer.is_closed_or_error(), pin=psu)))
+    return violations
+
+
+def _percentile(values, p):
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def run(threads=8, ops=200, seed=1, lock=True, time_scale=0.01, operations=OPERATIONS, logger=None, settings=None):
+    trace = Trace()
+    originalTime = package.time
+    originalGPIO = getattr(package, "GPIO", None)
+    package.time = _ScaledTime(time_scale)
+    try:
+        plugin, gpio, dataFolder = create_plugin(trace, lock=lock, logger=logger, settings=settings)
+
+        latencies = []
+        start = threading.Event()
+        workers = []
+        for i in range(threads):
+            rng = random.Random("%s:%d" % (seed, i))
+            schedule = [rng.choice(operations) for _ in range(ops)]
+            worker = threading.Thread(target=_worker, name="worker-%d" % i,
+                                      args=(plugin, trace, schedule, latencies, start))
+            worker.daemon = True
+            workers.append(worker)
+            worker.start()
+
+        began = time.time()
+        start.set()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - began
+
+        violations = check_final_state(plugin, gpio) + check_trace(list(trace.events))
+        shutil.rmtree(dataFolder, ignore_errors=True)
+    finally:
+        package.time = originalTime
+        if originalGPIO is None:
+            package.__dict__.pop("GPIO", None)
+        else:
+            package.GPIO = originalGPIO
+
+    return dict(elapsed=elapsed, latencies=latencies, trace=trace.events, violations=violations)
+
+
+def report(result, threads, seed, examples=3, name=None):
+    latencies = result["latencies"]
+    elapsed = result["elapsed"]
+    print("%sRan %d operations on %d threads in %.2fs (%.1f ops/s), seed %s" % (
+        "[%s] " % name if name else "", len(latencies), threads, elapsed, len(latencies) / max(elapsed, 1e-9), seed))
+
+    print("%-14s %6s %9s %9s %9s %9s %9s" % ("operation", "count", "mean ms", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    byOp = dict()
+    for op, seconds in latencies:
+        byOp.setdefault(op, []).append(seconds * 1000.0)
+    for op in sorted(byOp):
+        values = sorted(byOp[op])
+        print("%-14s %6d %9.2f %9.2f %9.2f %9.2f %9.2f" % (
+            op, len(values), sum(values) / len(values), _percentile(values, 0.5),
+            _percentile(values, 0.95), _percentile(values, 0.99), values[-1]))
+
+    violations = result["violations"]
+    print("Trace: %d events, %d violation(s)" % (len(result["trace"]), len(violations)))
+    counts = dict()
+    for kind, event in violations:
+        counts[kind] = counts.get(kind, 0) + 1
+        if counts[kind] > examples:
+            continue
+        print("  %s: %s" % (kind, json.dumps(event, sort_keys=True)))
+        if "seq" in event:
+            for e in result["trace"][max(0, event["seq"] - 4):event["seq"]]:
+                print("      after #%d %s %s(%s) %s %s" % (e["seq"], e["thread"], e["op"], e["opId"], e["kind"],
+                                                          json.dumps(e["detail"], sort_keys=True)))
+    for kind in sorted(counts):
+        print("%-10s %d" % (kind, counts[kind]))
+
+
+def _operation_list(value):
+    ops = [op for op in value.split(",") if op]
+    for op in ops:
+        if op not in OPERATIONS:
+            raise argparse.ArgumentTypeError("unknown operation %s" % op)
+    return ops
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stress PSU Control Plus switching and sensing from many threads")
+    parser.add_argument("--threads", type=int, default=8, help="Worker threads (default: %(default)s)")
+    parser.add_argument("--ops", type=int, default=200, help="Operations per thread (default: %(default)s)")
+    parser.add_argument("--seed", default="1", help="Seed for the operation mix (default: %(default)s)")
+    parser.add_argument("--operations", type=_operation_list, default=list(OPERATIONS),
+                        help="Comma separated operations to mix (default: all)")
+    parser.add_argument("--time-scale", type=float, default=0.01,
+                        help="Factor applied to the plugin's sleeps (default: %(default)s)")
+    parser.add_argument("--switch-interval", type=float, default=None,
+                        help="Interpreter thread switch interval in seconds, smaller forces more interleavings")
+    parser.add_argument("--sense-filter", choices=("both", "raw", "filtered"), default="both",
+                        help="Sense with the filter off, on or both one after the other (default: %(default)s)")
+    parser.add_argument("--no-lock", action="store_true",
+                        help="Run without the plugin's switching lock, to check the harness detects races")
+    parser.add_argument("--trace", help="Write the recorded traces to this file as JSON lines")
+    parser.add_argument("--verbose", action="store_true", help="Show plugin log output")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR,
+                        format="%(asctime)s %(threadName)s %(message)s")
+    if args.switch_interval is not None and hasattr(sys, "setswitchinterval"):
+        sys.setswitchinterval(args.switch_interval)
+
+    results = []
+    for name, settings in SENSE_CONFIGURATIONS:
+        if args.sense_filter not in ("both", name):
+            continue
+        result = run(threads=args.threads, ops=args.ops, seed=args.seed, lock=not args.no_lock,
+                     time_scale=args.time_scale, operations=args.operations, settings=settings)
+        report(result, args.threads, args.seed, name=name)
+        results.append((name, result))
+
+    if args.trace:
+        with open(args.trace, "w") as f:
+            for name, result in results:
+                for event in result["trace"]:
+                    f.write(json.dumps(dict(event, configuration=name), sort_keys=True) + "\n")
+
+    return 1 if any(result["violations"] for name, result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())